@@ -0,0 +1,190 @@
+import gzip
+import json
+import logging
+import os
+import zlib
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from model import Order, Projection, project_order
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveStore:
+    """
+    Archived orders kept in append-only, gzip-compressed segment files.
+
+    Every write appends one gzip member of JSON lines to the newest
+    segment, and a new segment is started once it holds ``segment_size``
+    records. Taking an order out of the archive appends a tombstone.
+    Only the segment number of each archived order id is kept in memory;
+    the orders themselves are read from disk one segment at a time.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 1000):
+        self._directory = directory
+        self._segment_size = segment_size
+        self._locations: Dict[int, int] = {}
+        self._live: Dict[int, int] = defaultdict(int)
+        self._segment = 1
+        self._records = 0
+        self._truncated: Set[int] = set()
+        # The last segment read, since turning pages reads the same one again.
+        self._cached: Optional[Tuple[int, List[str]]] = None
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def __len__(self) -> int:
+        return len(self._locations)
+
+    def __contains__(self, id_: int) -> bool:
+        return id_ in self._locations
+
+    def append(self, orders: Iterable[Order]):
+        orders = list(orders)
+        if not orders:
+            return
+        self._write([f'{{"order": {order.model_dump_json()}}}' for order in orders])
+        for order in orders:
+            self._move(order.id, self._segment)
+
+    def remove(self, ids: Iterable[int]) -> List[Order]:
+        removed = [order for order in map(self.get, ids) if order is not None]
+        if not removed:
+            return []
+        self._write([json.dumps({'removed': order.id}) for order in removed])
+        for order in removed:
+            self._move(order.id, None)
+        self._drop_dead_segments()
+        return removed
+
+    def get(self, id_: int) -> Optional[Order]:
+        segment = self._locations.get(id_)
+        if segment is None:
+            return None
+        key = str(id_)
+        # Only lines mentioning the id are parsed, the newest copy wins.
+        for line in reversed(self._lines(segment)):
+            if key not in line:
+                continue
+            try:
+                data = json.loads(line).get('order')
+            except ValueError:
+                continue
+            if data is not None and data['id'] == id_:
+                return Order(**data)
+        return None
+
+    def iter_orders(self, offset: int = 0, fields: Optional[Projection] = None) -> Iterator:
+        """
+        Yields archived orders, the most recently archived first, or records
+        with just ``fields`` of them if given.
+        """
+        for segment in sorted(self._live, reverse=True):
+            if offset >= self._live[segment]:
+                offset -= self._live[segment]
+                continue
+            seen = set()
+            # Parsed newest first and only as far as the caller reads.
+            for line in reversed(self._lines(segment)):
+                try:
+                    data = json.loads(line).get('order')
+                except ValueError:
+                    continue
+                if data is None or data['id'] in seen or self._locations.get(data['id']) != segment:
+                    continue
+                seen.add(data['id'])
+                if offset:
+                    offset -= 1
+                    continue
+                yield Order(**data) if fields is None else project_order(data, fields)
+
+    def _move(self, id_: int, segment: Optional[int]):
+        previous = self._locations.pop(id_, None)
+        if previous is not None:
+            self._live[previous] -= 1
+            if not self._live[previous]:
+                del self._live[previous]
+        if segment is not None:
+            self._locations[id_] = segment
+            self._live[segment] += 1
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self._directory, f'{segment:06d}.jsonl.gz')
+
+    def _segments(self) -> List[int]:
+        return sorted(
+            int(name.split('.')[0]) for name in os.listdir(self._directory)
+            if name.endswith('.jsonl.gz')
+        )
+
+    def _lines(self, segment: int) -> List[str]:
+        if self._cached is not None and self._cached[0] == segment:
+            return self._cached[1]
+        with open(self._path(segment), 'rb') as f:
+            data = f.read()
+        chunks = []
+        # One gzip member per write, so a torn write only loses its own member.
+        while data:
+            member = zlib.decompressobj(wbits=31)
+            try:
+                chunk = member.decompress(data)
+            except zlib.error:
+                member = None
+            if member is None or not member.eof:
+                self._mark_truncated(segment)
+                break
+            chunks.append(chunk)
+            data = member.unused_data
+        lines = b''.join(chunks).decode('utf-8').splitlines()
+        self._cached = (segment, lines)
+        return lines
+
+    def _read(self, segment: int) -> Iterator[dict]:
+        for line in self._lines(segment):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                self._mark_truncated(segment)
+                return
+
+    def _mark_truncated(self, segment: int):
+        # An interrupted append. The orders it held were still in the hot
+        # table at that point, so only the intact records before it count.
+        logger.warning('Archive segment %s is truncated', self._path(segment))
+        self._truncated.add(segment)
+
+    def _write(self, lines: List[str]):
+        if self._records >= self._segment_size:
+            self._segment += 1
+            self._records = 0
+        if self._cached is not None and self._cached[0] == self._segment:
+            self._cached = None
+        with open(self._path(self._segment), 'ab') as f:
+            f.write(gzip.compress(''.join(f'{line}\n' for line in lines).encode('utf-8')))
+            f.flush()
+            os.fsync(f.fileno())
+        self._records += len(lines)
+
+    def _scan(self):
+        segments = self._segments()
+        for segment in segments:
+            records = 0
+            for record in self._read(segment):
+                records += 1
+                if 'order' in record:
+                    self._move(record['order']['id'], segment)
+                else:
+                    self._move(record['removed'], None)
+            # Never append after a torn record, start a new segment instead.
+            self._segment = segment
+            self._records = self._segment_size if segment in self._truncated else records
+
+    def _drop_dead_segments(self):
+        # Tombstones only refer to older segments, so a prefix of segments
+        # without live orders can be deleted without resurrecting anything.
+        for segment in self._segments():
+            if segment == self._segment or self._live.get(segment):
+                break
+            os.remove(self._path(segment))
@@ -0,0 +1,486 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Callable, Dict, Iterator, List, Optional
+
+from model import CustomerInfo, Order, OrderStatus, order_id
+from stats import DAY
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+FIRST_NAMES = ['Олександр', 'Марія', 'Іван', 'Оксана', 'Дмитро', 'Наталія', 'Андрій', 'Юлія', 'Сергій', 'Ірина']
+LAST_NAMES = ['Шевченко', 'Коваленко', 'Бондаренко', 'Ткаченко', 'Кравченко', 'Олійник', 'Мельник', 'Поліщук']
+CITIES = ['Київ', 'Львів', 'Одеса', 'Харків', 'Дніпро', 'Вінниця', 'Полтава', 'Івано-Франківськ']
+STREETS = ['вул. Хрещатик', 'просп. Перемоги', 'вул. Шевченка', 'вул. Грушевського', 'бул. Лесі Українки']
+PRODUCTS = ['Сукня', 'Кросівки', 'Куртка', 'Светр', 'Джинси', 'Сумка', 'Шарф', 'Футболка', 'Пальто', 'Черевики']
+COLORS = ['чорний', 'білий', 'червоний', 'синій', 'зелений', 'бежевий', 'сірий']
+SIZES = ['XS', 'S', 'M', 'L', 'XL', '38', '39', '40', '41']
+SHOPS = ['https://zara.com/ua', 'https://answear.ua', 'https://rozetka.com.ua', 'https://asos.com', 'https://intertop.ua']
+DELIVERY_SERVICES = ['Нова пошта', 'Укрпошта', 'Meest']
+
+
+class OrderGenerator:
+    """Seeded source of realistic orders, the same for every run with the same seed."""
+
+    def __init__(self, seed: int = 0, now: Optional[datetime] = None):
+        self.rng = random.Random(seed)
+        self.now = now or datetime(2024, 1, 1)
+
+    def customer(self) -> CustomerInfo:
+        rng = self.rng
+        return CustomerInfo(
+            full_name=f'{rng.choice(LAST_NAMES)} {rng.choice(FIRST_NAMES)}',
+            phone_number=f'+380 {rng.choice(["50", "63", "67", "73", "93", "97"])} '
+                         f'{rng.randrange(1000000):07d}',
+            shipping_address=f'{rng.choice(CITIES)}, {rng.choice(STREETS)}, {rng.randint(1, 200)}, '
+                             f'відділення №{rng.randint(1, 300)}',
+        )
+
+    def order(self) -> Order:
+        rng = self.rng
+        created_at = self.now - timedelta(seconds=rng.randrange(365 * 24 * 60 * 60))
+        status = rng.choices(list(OrderStatus), weights=[3, 2, 5])[0]
+        products = [
+            f'{rng.choice(PRODUCTS)} {rng.choice(COLORS)}, розмір {rng.choice(SIZES)}'
+            for _ in range(rng.randint(1, 8))
+        ]
+        order = Order(
+            id=order_id(created_at, rng.getrandbits(74)),
+            created_at=created_at,
+            customer_info=self.customer(),
+            shop_url=rng.choice(SHOPS),
+            products=products,
+            income=Decimal(rng.randint(500, 20000)),
+            price=Decimal(rng.randint(400, 18000)),
+            delivery_service=rng.choice(DELIVERY_SERVICES),
+            status=status,
+            products_tracking=[status != OrderStatus.NEW or rng.random() < 0.5 for _ in products],
+        )
+        if status != OrderStatus.NEW:
+            order.delivery_price = Decimal(rng.randint(50, 300))
+            order.service_fee = Decimal(rng.randint(20, 500))
+            order.received_at = created_at + timedelta(days=rng.randint(3, 20))
+        if status == OrderStatus.DONE:
+            order.received_by_customer_at = order.received_at + timedelta(days=rng.randint(1, 7))
+            if rng.random() < 0.6:
+                order.archived_at = order.received_by_customer_at + timedelta(days=rng.randint(1, 30))
+        return order
+
+    def orders(self, count: int) -> Iterator[Order]:
+        for _ in range(count):
+            yield self.order()
+
+
+def summarize(latencies: List[int], elapsed: float, peak_memory: int) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'calls': len(latencies),
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'p50_ms': latencies[len(latencies) // 2] / 1e6,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] / 1e6,
+        'mean_ms': statistics.fmean(latencies) / 1e6,
+        'peak_memory_kb': peak_memory / 1024,
+    }
+
+
+def measure(call: Callable[[], object], iterations: int, budget: float, memory_iterations: int = 20) -> dict:
+    """Times ``call`` until ``iterations`` calls or ``budget`` seconds, then samples its memory."""
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        begin = time.perf_counter_ns()
+        call()
+        latencies.append(time.perf_counter_ns() - begin)
+        if time.perf_counter() - started > budget:
+            break
+    elapsed = time.perf_counter() - started
+
+    # tracemalloc slows allocations down, so memory gets its own short pass.
+    tracemalloc.start()
+    for _ in range(min(memory_iterations, len(latencies))):
+        call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return summarize(latencies, elapsed, peak)
+
+
+def measure_once(call: Callable[[], object]) -> dict:
+    tracemalloc.start()
+    begin = time.perf_counter_ns()
+    call()
+    latency = time.perf_counter_ns() - begin
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return summarize([latency], latency / 1e9, peak)
+
+
+def populate(backend: str, orders: List[Order], workdir: str, storage: str, codec: str):
+    from archive import ArchiveStore
+    from repositories import SQLiteOrderRepository, open_db
+
+    archive = ArchiveStore(os.path.join(workdir, 'archive'))
+    archive.append(order for order in orders if order.archived_at)
+    hot = [order for order in orders if not order.archived_at]
+    if backend == 'tinydb':
+        database = open_db(os.path.join(workdir, 'db.json'), storage, codec)
+        database.table('orders').insert_multiple(order.model_dump() for order in hot)
+        database.close()
+    else:
+        repository = SQLiteOrderRepository(os.path.join(workdir, 'orders.sqlite3'), archive)
+        repository.import_orders(hot)
+        repository.close()
+
+
+def open_repository(backend: str, workdir: str, storage: str, codec: str):
+    from archive import ArchiveStore
+    from repositories import SQLiteOrderRepository, TinyDBOrderRepository, open_db
+
+    archive = ArchiveStore(os.path.join(workdir, 'archive'))
+    if backend == 'tinydb':
+        database = open_db(os.path.join(workdir, 'db.json'), storage, codec)
+        return TinyDBOrderRepository(database.table('orders'), archive)
+    return SQLiteOrderRepository(os.path.join(workdir, 'orders.sqlite3'), archive)
+
+
+def bench_repository(backend: str, orders: List[Order], workdir: str, args) -> Dict[str, dict]:
+    from handlers import SUMMARY_FIELDS
+    from repositories import cursor_of
+
+    results = {}
+    begin = time.perf_counter()
+    populate(backend, orders, workdir, args.storage, args.codec)
+    logger.info('Populated %s with %s orders in %.1fs', backend, len(orders), time.perf_counter() - begin)
+
+    holder = {}
+    results['open'] = measure_once(lambda: holder.setdefault('repository', open_repository(backend, workdir, args.storage, args.codec)))
+    repository = holder['repository']
+
+    rng = random.Random(args.seed)
+    hot = [order for order in orders if not order.archived_at]
+    generator = OrderGenerator(args.seed + 1)
+
+    def update():
+        order = rng.choice(hot)
+        order.income = Decimal(rng.randint(500, 20000))
+        repository.add(order)
+
+    results['add'] = measure(lambda: repository.add(generator.order()), args.iterations, args.budget)
+    results['add_update'] = measure(update, args.iterations, args.budget)
+    results['get'] = measure(lambda: repository.get(rng.choice(hot).id), args.iterations, args.budget)
+    results['get_by_status'] = measure(
+        lambda: repository.get_by_status(rng.choice(list(OrderStatus)), limit=args.page_size),
+        args.iterations, args.budget,
+    )
+    results['get_by_status_summary'] = measure(
+        lambda: repository.get_by_status(
+            rng.choice(list(OrderStatus)), limit=args.page_size, fields=SUMMARY_FIELDS,
+        ),
+        args.iterations, args.budget,
+    )
+    results['get_by_status_last_page'] = measure(
+        lambda: repository.get_by_status(
+            OrderStatus.DONE, limit=args.page_size,
+            offset=max(0, repository.count_by_status(OrderStatus.DONE) - args.page_size),
+        ),
+        args.iterations, args.budget,
+    )
+    results['get_archived'] = measure(
+        lambda: repository.get_archived(limit=args.page_size), args.iterations, args.budget
+    )
+    results['get_archived_summary'] = measure(
+        lambda: repository.get_archived(limit=args.page_size, fields=SUMMARY_FIELDS), args.iterations, args.budget
+    )
+    week_ago = max(order.created_at for order in hot) - timedelta(days=7)
+    results['get_range'] = measure(
+        lambda: repository.get_range(week_ago, limit=args.page_size, newest_first=True, fields=SUMMARY_FIELDS),
+        args.iterations, args.budget,
+    )
+    results['get_range_next_page'] = measure(
+        lambda: repository.get_range(
+            week_ago, limit=args.page_size, after=cursor_of(rng.choice(hot)), fields=SUMMARY_FIELDS,
+        ),
+        args.iterations, args.budget,
+    )
+    results['search_build'] = measure_once(lambda: repository.search(''))
+    queries = [
+        rng.choice(LAST_NAMES)[:4], f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+        rng.choice(CITIES), rng.choice(PRODUCTS).lower(), '067', '+380 67 1',
+    ]
+    results['search'] = measure(
+        lambda: repository.search(rng.choice(queries), limit=args.page_size, fields=SUMMARY_FIELDS),
+        args.iterations, args.budget,
+    )
+    results['stats_rebuild'] = measure_once(repository.rebuild_stats)
+    results['stats'] = measure(lambda: repository.get_stats(DAY, '2023-12-25', '2023-12-31'), args.iterations, args.budget)
+    results['close'] = measure_once(repository.close)
+    return results
+
+
+def bench_codecs(orders: List[Order], args) -> Dict[str, dict]:
+    """Encodes and decodes the orders as a TinyDB file with every codec."""
+    from tinydb_serialization.serializers import DateTimeSerializer
+
+    from storages import CODECS, DecimalSerializer, paused_gc
+
+    table = {str(n): order.model_dump() for n, order in enumerate(orders, 1)}
+    results = {}
+    for name, codec_class in CODECS.items():
+        codec = codec_class()
+        codec.register_serializer(DateTimeSerializer(), 'TinyDate')
+        codec.register_serializer(DecimalSerializer(), 'Decimal')
+        encoded = codec.dumps({'orders': table})
+
+        def load():
+            with paused_gc():
+                codec.loads(encoded)
+
+        iterations = max(1, min(args.iterations, 5))
+        results[f'codec_{name}_dump'] = measure(lambda: codec.dumps({'orders': table}), iterations, args.budget, 1)
+        results[f'codec_{name}_load'] = measure(load, iterations, args.budget, 1)
+        for operation in ('dump', 'load'):
+            results[f'codec_{name}_{operation}']['size_bytes'] = len(encoded)
+    return results
+
+
+def bench_rendering(orders: List[Order], args) -> Dict[str, dict]:
+    from rendering import format_model, render
+
+    rng = random.Random(args.seed)
+    sample = rng.sample(orders, min(len(orders), 1000))
+    return {
+        'format_model': measure(lambda: format_model(rng.choice(sample)), args.iterations, args.budget),
+        'render_cached': measure(lambda: render(rng.choice(sample)), args.iterations, args.budget),
+    }
+
+
+def bench_forms(args) -> Dict[str, dict]:
+    from typing import get_type_hints
+
+    from telegram import CallbackQuery, Update, User
+
+    from handlers import RECEIVE, RECEIVED_BY_ME, FormSchema, callback_router, generate_field_mapping, get_form_schema
+    from model import InProgressOrder, NewOrder
+
+    schema = get_form_schema(NewOrder)
+    answers = {field.path: None for field in schema.fields[:4]}
+    press = Update(1, callback_query=CallbackQuery(
+        '1', User(1, 'bench', False), '1', data=RECEIVE(random.Random(args.seed).getrandbits(128), RECEIVED_BY_ME),
+    ))
+    return {
+        'callback_dispatch': measure(lambda: callback_router.check_update(press), args.iterations, args.budget),
+        'generate_field_mapping': measure(
+            lambda: generate_field_mapping(get_type_hints(NewOrder), model=NewOrder), args.iterations, args.budget
+        ),
+        'compile_form_schema': measure(lambda: FormSchema(InProgressOrder), args.iterations, args.budget),
+        'form_next_field': measure(lambda: schema.next_field(answers), args.iterations, args.budget),
+    }
+
+
+class FakeMessage:
+    def __init__(self, chat_id: int, text: Optional[str] = None, message_id: int = 1):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.sent = 0
+
+    @property
+    def chat(self):
+        return FakeChat(self.chat_id)
+
+    async def reply_text(self, text: str, **kwargs):
+        self.sent += 1
+        return FakeMessage(self.chat_id, text, self.message_id + 1)
+
+    async def edit_text(self, text: str, **kwargs):
+        self.sent += 1
+        return self
+
+
+class FakeChat:
+    def __init__(self, id_: int):
+        self.id = id_
+        self.type = 'private'
+
+
+class FakeCallbackQuery:
+    def __init__(self, chat_id: int, data: str):
+        self.data = data
+        self.message = FakeMessage(chat_id)
+        self.from_user = FakeChat(chat_id)
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+class FakeUpdate:
+    """Just enough of ``telegram.Update`` for the handlers."""
+
+    def __init__(self, chat_id: int, text: Optional[str] = None, data: Optional[str] = None):
+        self.message = FakeMessage(chat_id, text) if text is not None else None
+        self.callback_query = FakeCallbackQuery(chat_id, data) if data is not None else None
+        self.effective_chat = FakeChat(chat_id)
+        self.effective_user = FakeChat(chat_id)
+
+
+def bench_conversation(backend: str, workdir: str, args) -> Dict[str, dict]:
+    import handlers
+    from model import NewOrder
+    from shards import ShardRouter
+
+    repository = open_repository(backend, workdir, args.storage, args.codec)
+    # All chats share the one populated repository.
+    handlers.orders = orders = ShardRouter(None, backend, open_repository=lambda backend, directory: repository)
+    schema = handlers.get_form_schema(NewOrder)
+    generator = OrderGenerator(args.seed + 2)
+
+    async def conversation(chat_id: int):
+        handlers.sessions.create(chat_id)
+        order = generator.order()
+        await handlers.add_order(FakeUpdate(chat_id, data=handlers.ADD_ORDER()), None)
+        for field in schema.fields:
+            value = order.model_dump()
+            for key in field.path.split('.'):
+                value = value[key]
+            if not field.is_list:
+                await handlers.handle_text(FakeUpdate(chat_id, text=str(value)), None)
+                continue
+            # The first item arrives while a field is being selected, the rest while adding items.
+            first, *rest = value
+            await handlers.handle_text(FakeUpdate(chat_id, text=first), None)
+            for item in rest:
+                await handlers.handle_list_item(FakeUpdate(chat_id, text=item), None)
+            await handlers.handle_list_item(FakeUpdate(chat_id, text='/skip'), None)
+
+    async def run():
+        latencies = []
+        started = time.perf_counter()
+        for chat_id in range(1, args.iterations + 1):
+            begin = time.perf_counter_ns()
+            await conversation(chat_id)
+            latencies.append(time.perf_counter_ns() - begin)
+            if time.perf_counter() - started > args.budget:
+                break
+        elapsed = time.perf_counter() - started
+        tracemalloc.start()
+        for chat_id in range(-20, 0):
+            await conversation(chat_id)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        await orders.close()
+        return summarize(latencies, elapsed, peak)
+
+    return {'conversation': asyncio.run(run())}
+
+
+def run(args) -> dict:
+    results = []
+    generator = OrderGenerator(args.seed)
+    all_orders: List[Order] = []
+    for size in sorted(args.sizes):
+        begin = time.perf_counter()
+        all_orders.extend(generator.orders(size - len(all_orders)))
+        orders = all_orders[:size]
+        logger.info('Generated %s orders in %.1fs', size, time.perf_counter() - begin)
+
+        for backend in args.backends:
+            workdir = tempfile.mkdtemp(prefix=f'bench-{backend}-{size}-', dir=args.workdir)
+            groups = bench_repository(backend, orders, workdir, args)
+            if backend == 'tinydb':
+                groups.update(bench_codecs(orders, args))
+            groups.update(bench_rendering(orders, args))
+            groups.update(bench_forms(args))
+            if not args.skip_conversation:
+                groups.update(bench_conversation(backend, workdir, args))
+            for operation, metrics in groups.items():
+                results.append({'size': size, 'backend': backend, 'operation': operation, **metrics})
+                logger.info(
+                    '%8d %-7s %-25s p50 %9.3f ms  p99 %9.3f ms  %10.1f ops/s  %9.1f KiB',
+                    size, backend, operation, metrics['p50_ms'], metrics['p99_ms'],
+                    metrics['throughput'] or 0, metrics['peak_memory_kb'],
+                )
+    return {
+        'meta': {
+            'created_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'iterations': args.iterations,
+            'storage': args.storage,
+            'codec': args.codec,
+        },
+        'results': results,
+    }
+
+
+def compare(baseline_path: str, current_path: str, threshold: float) -> int:
+    with open(baseline_path) as f:
+        baseline = {(r['size'], r['backend'], r['operation']): r for r in json.load(f)['results']}
+    with open(current_path) as f:
+        current = json.load(f)['results']
+
+    regressions = 0
+    for result in current:
+        before = baseline.get((result['size'], result['backend'], result['operation']))
+        if before is None or not before['p50_ms']:
+            continue
+        ratio = result['p50_ms'] / before['p50_ms']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(
+            f"{result['size']:>8} {result['backend']:<7} {result['operation']:<25} "
+            f"p50 {before['p50_ms']:9.3f} -> {result['p50_ms']:9.3f} ms ({ratio:5.2f}x){flag}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark storage, rendering and conversation flows')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--backends', nargs='+', choices=['tinydb', 'sqlite'], default=['tinydb', 'sqlite'])
+    parser.add_argument('--storage', choices=['json', 'wal'], default='wal', help='TinyDB storage to benchmark')
+    parser.add_argument('--codec', choices=['json', 'msgpack'], default='json', help='TinyDB codec to benchmark')
+    parser.add_argument('--iterations', type=int, default=200, help='Calls per operation')
+    parser.add_argument('--budget', type=float, default=10, help='Seconds per operation at most')
+    parser.add_argument('--page-size', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help='Where to create the benchmark databases')
+    parser.add_argument('--skip-conversation', action='store_true')
+    parser.add_argument('-o', '--output', default='bench_results.json')
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+        help='Compare two saved result files instead of running',
+    )
+    parser.add_argument('--threshold', type=float, default=0.1, help='Slowdown reported as a regression')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if args.compare:
+        raise SystemExit(1 if compare(*args.compare, args.threshold) else 0)
+
+    # handlers opens the configured repository on import, keep it out of the way.
+    args.output = os.path.abspath(args.output)
+    args.workdir = args.workdir and os.path.abspath(args.workdir)
+    os.chdir(tempfile.mkdtemp(prefix='bench-', dir=args.workdir))
+
+    report = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info('Saved results to %s', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import base64
+import binascii
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import BaseHandler, CallbackContext
+
+# Telegram rejects longer callback data.
+MAX_CALLBACK_DATA = 64
+
+
+def pack(args: Iterable[int]) -> str:
+    """Non-negative integers as LEB128 varints in unpadded URL-safe base64."""
+    data = bytearray()
+    for value in args:
+        if value < 0:
+            raise ValueError(f'Negative callback argument: {value}')
+        while value > 0x7f:
+            data.append(value & 0x7f | 0x80)
+            value >>= 7
+        data.append(value)
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def unpack(text: str) -> List[int]:
+    """Raises ``ValueError`` unless ``text`` was made by ``pack``."""
+    try:
+        data = base64.b64decode(text + '=' * (-len(text) % 4), altchars=b'-_', validate=True)
+    except binascii.Error as e:
+        raise ValueError(f'Malformed callback payload: {text!r}') from e
+    args = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            args.append(value)
+            value = shift = 0
+    if shift:
+        raise ValueError(f'Truncated callback payload: {text!r}')
+    return args
+
+
+class Action(NamedTuple):
+    """
+    A kind of button press. Calling it with the arguments gives the button's
+    callback data: the one-character ``code`` followed by the packed
+    arguments, about 26 characters for a 128-bit order id.
+    """
+    code: str
+
+    def __call__(self, *args: int) -> str:
+        data = self.code + pack(args)
+        if len(data) > MAX_CALLBACK_DATA:
+            raise ValueError(f'Callback data is {len(data)} characters long')
+        return data
+
+
+class CallbackRouter(BaseHandler[Update, CallbackContext]):
+    """
+    Handles the callback queries of all registered actions, finding the
+    callback by the action code in a dict rather than trying a pattern per
+    action. The callback gets the unpacked arguments as ``context.args``.
+    Callback data it can't decode is left to the handlers after it.
+    """
+
+    def __init__(self):
+        super().__init__(self._dispatch)
+        self.routes: Dict[str, Callable] = {}
+
+    def route(self, action: Action, callback: Callable):
+        if action.code in self.routes:
+            raise ValueError(f'Action code {action.code!r} is already routed')
+        self.routes[action.code] = callback
+
+    def check_update(self, update: object) -> Optional[Tuple[Callable, List[int]]]:
+        if not isinstance(update, Update) or update.callback_query is None:
+            return None
+        data = update.callback_query.data
+        if not isinstance(data, str) or not data:
+            return None
+        callback = self.routes.get(data[0])
+        if callback is None:
+            return None
+        try:
+            return callback, unpack(data[1:])
+        except ValueError:
+            return None
+
+    def collect_additional_context(self, context: CallbackContext, update: Update, application, check_result):
+        context.args = check_result[1]
+
+    async def handle_update(self, update: Update, application, check_result, context: CallbackContext):
+        self.collect_additional_context(context, update, application, check_result)
+        return await check_result[0](update, context)
+
+    async def _dispatch(self, update: Update, context: CallbackContext):
+        callback, context.args = self.check_update(update)
+        return await callback(update, context)
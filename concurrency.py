@@ -0,0 +1,81 @@
+import asyncio
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import AsyncIterator, Awaitable, Dict, Hashable, Iterable, Optional
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class KeyedLock:
+    """
+    One ``asyncio.Lock`` per key, dropped once nobody holds or waits for it.
+    """
+
+    def __init__(self):
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._queued: Dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._queued[key] = self._queued.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._queued[key] -= 1
+            if not self._queued[key]:
+                del self._queued[key]
+                del self._locks[key]
+
+    @asynccontextmanager
+    async def hold_many(self, keys: Iterable[Hashable]) -> AsyncIterator[None]:
+        """
+        Holds the locks of all ``keys``, taken in sorted order so that no
+        two holders of several locks wait on each other.
+        """
+        async with AsyncExitStack() as stack:
+            for key in sorted(set(keys)):
+                await stack.enter_async_context(self.hold(key))
+            yield
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different chats concurrently and updates of the
+    same chat one at a time, in arrival order.
+
+    ``ConversationHandler`` keeps one state per chat and expects updates to
+    arrive one by one, which this still guarantees within every chat. The
+    chat lock is taken before a concurrency slot, so a chat flooding the
+    bot only queues behind itself.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chats = KeyedLock()
+
+    async def process_update(self, update: object, coroutine: Awaitable) -> None:
+        chat_id = self._chat_id(update)
+        if chat_id is None:
+            await super().process_update(update, coroutine)
+            return
+
+        async with self._chats.hold(chat_id):
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @staticmethod
+    def _chat_id(update: object) -> Optional[int]:
+        chat = getattr(update, 'effective_chat', None)
+        return chat.id if chat is not None else None
@@ -0,0 +1,49 @@
+import argparse
+import logging
+import os
+
+from repositories import DB_CODEC, DB_PATH, open_codec
+from shards import SHARDS_DIR, chat_directory
+from storages import CODECS, convert_database
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rewrite a TinyDB file and its write-ahead log with another DB_CODEC. '
+                    'Run it while the bot is stopped.'
+    )
+    parser.add_argument('path', nargs='?', help=f'Database file, {DB_PATH} by default')
+    parser.add_argument('--to', choices=list(CODECS), default=DB_CODEC, help='Codec to convert to, DB_CODEC by default')
+    parser.add_argument('--chat', type=int, help='Chat whose database to convert when orders are sharded by chat')
+    parser.add_argument('--all-chats', action='store_true', help='Convert the database of every chat')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.all_chats:
+        if SHARDS_DIR is None:
+            parser.error('--all-chats only applies to orders sharded by chat, DB_SHARDS_DIR is not set')
+        paths = [
+            os.path.join(SHARDS_DIR, name, os.path.basename(DB_PATH))
+            for name in sorted(os.listdir(SHARDS_DIR)) if name.lstrip('-').isdigit()
+        ]
+    elif args.path is not None:
+        paths = [args.path]
+    else:
+        directory = chat_directory(parser, args.chat)
+        paths = [DB_PATH if directory is None else os.path.join(directory, os.path.basename(DB_PATH))]
+
+    codecs = {name: open_codec(name) for name in CODECS}
+    for path in paths:
+        source = convert_database(path, codecs, args.to)
+        if source is None:
+            logger.info('%s is empty or in no known format, left as it is', path)
+        elif source == args.to:
+            logger.info('%s is already in the %s format', path, args.to)
+        else:
+            logger.info('Converted %s from %s to %s', path, source, args.to)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,8 @@ def get(
     default: Any = not_provided
 ) -> Any:
     value = os.getenv(key)
-    if value is None and default is not_provided:
-        raise ConfigurationOptionNotProvided(key)
+    if value is None:
+        if default is not_provided:
+            raise ConfigurationOptionNotProvided(key)
+        return default
     return coerce(value)
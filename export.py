@@ -0,0 +1,167 @@
+import argparse
+import csv
+import json
+import logging
+import sys
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from enum import Enum
+from itertools import chain, islice
+from typing import Callable, Collection, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from model import OrderStatus
+from repositories import DB_BACKEND, create_order_repository
+from shards import chat_directory
+
+logger = logging.getLogger(__name__)
+
+# Everything bookkeeping needs, with the customer info flattened.
+EXPORT_FIELDS = (
+    'id', 'created_at', 'customer_info.full_name', 'customer_info.phone_number',
+    'customer_info.shipping_address', 'shop_url', 'products', 'products_tracking',
+    'income', 'price', 'delivery_service', 'delivery_price', 'service_fee',
+    'received_at', 'received_by_customer_at', 'status', 'archived_at',
+)
+COLUMNS = tuple(field.rpartition('.')[2] for field in EXPORT_FIELDS)
+FORMATS = ('csv', 'jsonl')
+# Which orders to take by whether they are archived.
+INCLUDE, EXCLUDE, ONLY = 'include', 'exclude', 'only'
+# Separates the products of an order in a CSV cell.
+PRODUCT_SEPARATOR = '; '
+
+Period = Tuple[Optional[datetime], Optional[datetime]]
+
+
+def parse_period(text: str) -> Period:
+    """
+    ``2024-03-05`` is that day, ``2024-03`` that month, and ``FROM..TO``
+    everything from the start of one to the end of the other, where
+    either side may be left out. Returns the start and the exclusive end.
+    """
+    first, separator, last = text.partition('..')
+    if not separator:
+        last = first
+    start = _period_bounds(first)[0] if first else None
+    end = _period_bounds(last)[1] if last else None
+    return start, end
+
+
+def _period_bounds(text: str) -> Period:
+    if len(text) == len('2024-03'):
+        start = datetime.strptime(text, '%Y-%m')
+        return start, (start + timedelta(days=31)).replace(day=1)
+    start = datetime.combine(date.fromisoformat(text), datetime.min.time())
+    return start, start + timedelta(days=1)
+
+
+def export_batches(
+    repository, statuses: Optional[Collection[OrderStatus]] = None, archived: str = INCLUDE,
+    period: Period = (None, None), batch_size: int = 500,
+) -> Iterator[list]:
+    """
+    Yields the matching orders as ``EXPORT_FIELDS`` records, ``batch_size``
+    at a time: the live ones by creation time, then the archived ones,
+    the most recently archived first. Only one batch is held at a time.
+    """
+    start, end = period
+    records = iter(())
+    if archived != ONLY:
+        records = repository.iter_range(start, end, fields=EXPORT_FIELDS, batch_size=batch_size)
+    if archived != EXCLUDE:
+        archive = (
+            record for record in repository.archive.iter_orders(fields=EXPORT_FIELDS)
+            if (start is None or record.created_at is not None and record.created_at >= start)
+            and (end is None or record.created_at is not None and record.created_at < end)
+        )
+        records = chain(records, archive)
+    if statuses is not None:
+        records = (record for record in records if record.status in statuses)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _format(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, (Decimal, int)) and not isinstance(value, bool):
+        return str(value)
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+def flatten(record, csv_cells: bool = False) -> dict:
+    """A record as a flat row. CSV cells get the products and their tracking marks joined into one."""
+    row = {name: _format(value) for name, value in zip(COLUMNS, record)}
+    if csv_cells:
+        row['products'] = PRODUCT_SEPARATOR.join(row['products'] or [])
+        row['products_tracking'] = ''.join('+' if tracked else '-' for tracked in row['products_tracking'] or [])
+    return row
+
+
+def row_writer(f: TextIO, fmt: str) -> Callable[[List[tuple]], None]:
+    """Returns a function writing batches of records to ``f``. A CSV header is written right away."""
+    if fmt == 'csv':
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        return lambda batch: writer.writerows(flatten(record, csv_cells=True) for record in batch)
+    if fmt == 'jsonl':
+        return lambda batch: f.writelines(
+            json.dumps(flatten(record), ensure_ascii=False) + '\n' for record in batch
+        )
+    raise ValueError(f'Unknown export format: {fmt}')
+
+
+def export(f: TextIO, fmt: str, batches: Iterable[list]) -> int:
+    """Writes all ``batches`` to ``f``, returns how many orders there were."""
+    write = row_writer(f, fmt)
+    count = 0
+    for batch in batches:
+        write(batch)
+        count += len(batch)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write orders to a CSV or JSON Lines file')
+    parser.add_argument('-f', '--format', choices=FORMATS, default='csv')
+    parser.add_argument(
+        '-s', '--status', choices=[status.value for status in OrderStatus], nargs='+', default=None,
+        help='Only orders with these statuses',
+    )
+    parser.add_argument(
+        '-a', '--archived', choices=[INCLUDE, EXCLUDE, ONLY], default=INCLUDE,
+        help='Whether to export archived orders too, leave them out, or export only them',
+    )
+    parser.add_argument(
+        '-p', '--period', type=parse_period, default=(None, None),
+        help='Orders created on a day (2024-03-05), in a month (2024-03) or from one to another (2024-01..2024-03)',
+    )
+    parser.add_argument('--backend', choices=['tinydb', 'sqlite'], default=DB_BACKEND)
+    parser.add_argument('--chat', type=int, help='Chat whose orders to export when they are sharded by chat')
+    parser.add_argument('-o', '--output', default='-', help='File to write, standard output by default')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    directory = chat_directory(parser, args.chat)
+
+    statuses = args.status and {OrderStatus(status) for status in args.status}
+    repository = create_order_repository(args.backend, directory)
+    try:
+        batches = export_batches(repository, statuses, args.archived, args.period)
+        if args.output == '-':
+            count = export(sys.stdout, args.format, batches)
+        else:
+            # Excel only reads UTF-8 CSV files as such with a byte order mark.
+            encoding = 'utf-8-sig' if args.format == 'csv' else 'utf-8'
+            with open(args.output, 'w', encoding=encoding, newline='') as f:
+                count = export(f, args.format, batches)
+    finally:
+        repository.close()
+    logger.info('Exported %s orders', count)
+
+
+if __name__ == '__main__':
+    main()
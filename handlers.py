@@ -1,15 +1,25 @@
+import asyncio
 import inspect
+import io
 import logging
-from datetime import datetime
-from typing import List, get_type_hints, Type
+import tempfile
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Set, Tuple, Type, get_origin, get_type_hints
 
 from pydantic import BaseModel
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from telegram.ext import ConversationHandler, CallbackContext, \
     ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler
-from telegram.helpers import escape_markdown
-from model import NewOrder, EditableModel, Order, OrderStatus, InProgressOrder
-from repositories import OrderRepository
+import env
+from callbacks import Action, CallbackRouter
+from concurrency import KeyedLock
+from export import EXCLUDE, FORMATS, INCLUDE, ONLY, export_batches, parse_period, row_writer
+from model import NewOrder, EditableModel, Order, OrderStatus, InProgressOrder, AmbiguousAmountError, parse_money
+from rendering import display_data, send
+from sessions import SessionStore
+from shards import ShardRouter
+from stats import ARCHIVED, DAY, MONTH, STATUS, Totals
 
 logger = logging.getLogger(__name__)
 
@@ -27,7 +37,12 @@ logger = logging.getLogger(__name__)
 #     list_field1: List[str] = Field(default_factory=list, title='List Field 1')
 #     list_field2: List[str] = Field(default_factory=list, title='List Field 2')
 
-orders = OrderRepository()
+# Every chat's orders, see ``ShardRouter``; handlers use ``orders.of(chat_id)``.
+orders = ShardRouter()
+# Held around every read-modify-write of an order, so concurrently processed
+# updates of the same order apply one after another. The repository still
+# rejects stale writes, e.g. from another process.
+order_locks = KeyedLock()
 BASE_MODEL = NewOrder
 
 
@@ -46,16 +61,105 @@ def generate_field_mapping(field_dict, prefix="", title_prefix="", model: Type[E
     return mapping
 
 
+class FormField(NamedTuple):
+    path: str
+    prompt: str
+    is_list: bool
+    # Turns the typed answer into the stored value, raising ValueError if it can't.
+    parse: Optional[Callable[[str], Any]] = None
+
+
+FIELD_PARSERS: Dict[Any, Callable[[str], Any]] = {
+    Optional[Decimal]: parse_money,
+}
+
+
+class FormSchema:
+    """
+    The questions asked to fill an ``EditableModel``, in order.
+
+    Compiled once per model class, so conversation steps look fields up
+    instead of reflecting over the model again.
+    """
+
+    def __init__(self, model: Type[EditableModel]):
+        self.model = model
+        mapping = generate_field_mapping(get_type_hints(model), model=model)
+        self.fields: Tuple[FormField, ...] = tuple(
+            FormField(
+                path, prompt, get_origin(self._field_type(model, path)) is list,
+                FIELD_PARSERS.get(self._field_type(model, path)),
+            )
+            for path, prompt in mapping.items()
+        )
+        self._positions = {field.path: position for position, field in enumerate(self.fields)}
+
+    def field(self, path: str) -> FormField:
+        return self.fields[self._positions[path]]
+
+    def next_field(self, answers: dict) -> Optional[FormField]:
+        """The first field in form order without an answer."""
+        for field in self.fields:
+            if field.path not in answers:
+                return field
+        return None
+
+    def build(self, answers: dict) -> EditableModel:
+        return self.model(**unflatten_dict(answers))
+
+    @staticmethod
+    def _field_type(model: Type[BaseModel], path: str):
+        *parents, name = path.split('.')
+        for parent in parents:
+            model = get_type_hints(model)[parent]
+        return get_type_hints(model)[name]
+
+
+FORM_SCHEMAS: Dict[Type[EditableModel], FormSchema] = {
+    model: FormSchema(model) for model in (NewOrder, InProgressOrder)
+}
+
+
+def get_form_schema(model: Type[EditableModel]) -> FormSchema:
+    if model not in FORM_SCHEMAS:
+        FORM_SCHEMAS[model] = FormSchema(model)
+    return FORM_SCHEMAS[model]
+
+
 # Conversation states
 # FIELD_MAPPING = generate_field_mapping(get_type_hints(BASE_MODEL))
 
 # Data storage for user inputs
-user_data = {}
-current_models = {}
+sessions = SessionStore(
+    ttl=env.get('SESSION_TTL', float, 7 * 24 * 60 * 60),
+    maxsize=env.get('SESSION_LIMIT', int, 10000),
+)
 
 # Conversation handler states
 SELECTING_FIELD, ADDING_LIST_ITEM, SKIP_LIST, MENU, PASSWORD = range(5)
 
+# Inline button actions and their arguments. The codes are upper case, so
+# they never match the dotted callback data of buttons sent before them.
+ADD_ORDER = Action('A')
+LIST = Action('L')  # listing number
+PAGE = Action('P')  # listing number, offset
+OPEN = Action('O')  # order id
+RECEIVE = Action('R')  # order id, RECEIVED_BY_ME or RECEIVED_BY_CUSTOMER
+CONTINUE = Action('C')  # order id
+FILL_TRACKING = Action('T')  # order id, and the product index to mark
+ARCHIVE = Action('X')  # order id
+RESTORE = Action('U')  # order id
+SEARCH_PAGE = Action('S')  # offset
+SELECT = Action('M')  # listing number, offset
+TOGGLE = Action('K')  # listing number, offset, order id
+APPLY = Action('Y')  # listing number, BULK_ARCHIVE, BULK_RECEIVE or BULK_RESTORE
+ARCHIVE_DONE = Action('D')  # 1 once confirmed
+
+RECEIVED_BY_ME, RECEIVED_BY_CUSTOMER = range(2)
+BULK_ARCHIVE, BULK_RECEIVE, BULK_RESTORE = range(3)
+# Orders archived with one storage write by "archive all done".
+ARCHIVE_BATCH_SIZE = env.get('ARCHIVE_BATCH_SIZE', int, 100)
+
 # orders = {
 #     '1': Order(
 #         id="1",
@@ -87,17 +191,15 @@ def unflatten_dict(dotted_dict):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the conversation and asks the user about their gender."""
     logger.info('START COMMAND')
-    if str(update.message.chat.id) not in user_data.keys():
-        await update.message.reply_text("Розкажи секрет")
-        return PASSWORD
-    reply_keyboard = [
-        [InlineKeyboardButton(text='Додати замовлення', callback_data='add_order')],
-        [InlineKeyboardButton(text='Нові замовлення', callback_data='new_orders')],
-        [InlineKeyboardButton(text='Замовлення у процесі', callback_data='in_progress_orders')],
-        [InlineKeyboardButton(text='Виконані замовлення', callback_data='done_orders')],
-        [InlineKeyboardButton(text='Архів', callback_data='archived_orders')],
-    ]
-    current_models[str(update.message.chat.id)] = None
+    session = sessions.get(update.effective_chat.id)
+    if session is None:
+        return await ask_password(update.message)
+    reply_keyboard = [[InlineKeyboardButton(text='Додати замовлення', callback_data=ADD_ORDER())]]
+    reply_keyboard.extend(
+        [InlineKeyboardButton(text=title, callback_data=LIST(listing))]
+        for listing, (title, _) in enumerate(LISTINGS)
+    )
+    session.form = None
 
     await update.message.reply_text(
         """Головне меню""",
@@ -109,11 +211,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return MENU
 
 
+async def ask_password(message: Message) -> int:
+    await message.reply_text("Розкажи секрет")
+    return PASSWORD
+
+
 async def handle_password(update: Update, context: CallbackContext) -> int:
     user_input = update.message.text
     if user_input == datetime.now().strftime("%d*%m*%Y"):
         await update.message.reply_text("Чудово!")
-        user_data[str(update.message.chat.id)] = {}
+        sessions.create(update.effective_chat.id)
         return MENU
     else:
         await update.message.reply_text("Вийди отсюда, розбійник!")
@@ -121,20 +228,25 @@ async def handle_password(update: Update, context: CallbackContext) -> int:
 
 
 async def fill_tracking(update: Update, context: CallbackContext):
-    params = update.callback_query.data.split('.')[1:]
+    order_id, *params = context.args
+    chat_orders = orders.of(update.effective_chat.id)
 
-    if len(params) > 1:
-        order_id, idx = params
-        order = orders.get(int(order_id))
+    async with order_locks.hold(order_id):
+        if params:
+            idx = params[0]
 
-        order.products_tracking[int(idx)] = True
-        method = update.callback_query.message.edit_text
-    else:
-        order_id = params[-1]
-        order = orders.get(int(order_id))
-        method = update.callback_query.message.reply_text
+            def mark_tracked(order: Order):
+                order.products_tracking[idx] = True
+
+            order = await chat_orders.update(order_id, mark_tracked)
+            method = 'edit_text'
+        else:
+            order = await chat_orders.get(order_id)
+            method = 'reply_text'
 
-    orders.add(order)
+    if order is None:
+        await update.callback_query.message.reply_text('Замовлення не знайдено')
+        return MENU
 
     reply_keyboard = []
 
@@ -143,164 +255,459 @@ async def fill_tracking(update: Update, context: CallbackContext):
             continue
 
         reply_keyboard.append(
-            [InlineKeyboardButton(text=product, callback_data=f'fill_tracking.{order_id}.{idx}')]
+            [InlineKeyboardButton(text=product, callback_data=FILL_TRACKING(order_id, idx))]
         )
 
+    message = update.callback_query.message
     if len(reply_keyboard):
-        await method(
+        await send(
+            message,
             """Оберіть товари по яких сформовано ТТН""",
+            method,
             reply_markup=InlineKeyboardMarkup(
                 reply_keyboard,
             ),
         )
     else:
-        await method('Всі товари заповнено')
+        await send(message, 'Всі товари заповнено', method)
     return MENU
 
 
-async def in_progress_orders(update: Update, context: CallbackContext):
-    _orders = orders.get_by_status(OrderStatus.IN_PROGRESS)
-    if not len(_orders):
-        await update.callback_query.message.reply_text('Немає заявок')
-
-    for order in _orders:
-
-        reply_keyboard = [
-            [InlineKeyboardButton(text='Отримано клієнтом', callback_data=f'receive.{order.id}.customer')],
-        ]
-        if not order.received_at:
-            reply_keyboard.insert(0, [InlineKeyboardButton(text='Отримано мною', callback_data=f'receive.{order.id}.me')])
-
-        reply_keyboard.append(
-            [InlineKeyboardButton(text='Архівувати', callback_data=f'archive.{order.id}')],
-        )
-
-        await display_data(
-            update.callback_query.message, order,
-            reply_markup=InlineKeyboardMarkup(
-                reply_keyboard,
-            ),
-        )
-
-
-async def done_orders(update: Update, context: CallbackContext):
-    _orders = orders.get_by_status(OrderStatus.DONE)
-    if not len(_orders):
-        await update.callback_query.message.reply_text('Немає заявок')
-
-    for order in _orders:
-        reply_keyboard = [
-            [InlineKeyboardButton(text='Архівувати', callback_data=f'archive.{order.id}')],
-        ]
-
-        await display_data(
-            update.callback_query.message, order,
-            reply_markup=InlineKeyboardMarkup(
-                reply_keyboard,
-            ),
-        )
-
-
-async def archived_orders(update: Update, context: CallbackContext):
-    _orders = orders.get_archived()
-    if not len(_orders):
-        await update.callback_query.message.reply_text('Немає заявок')
-
-    for order in _orders:
-        reply_keyboard = [
-            [InlineKeyboardButton(text='Відновити', callback_data=f'restore.{order.id}')],
-        ]
-
-        await display_data(
-            update.callback_query.message, order,
-            reply_markup=InlineKeyboardMarkup(
-                reply_keyboard,
-            ),
-        )
-
-
 async def archive_order(update: Update, context: CallbackContext):
-    order_id = update.callback_query.data.split('.')[-1]
+    order_id, = context.args
     chat_id = update.callback_query.from_user.id
     message_id = update.callback_query.message.id
-    order = orders.get(int(order_id))
-    order.archived_at = datetime.now()
-    orders.add(order)
+    async with order_locks.hold(order_id):
+        await orders.of(update.effective_chat.id).archive_order(order_id)
     await context.bot.delete_message(chat_id, message_id)
 
 
+async def archive_in_batches(chat_orders, next_batch: Callable[[], Awaitable[list]]) -> int:
+    """
+    Archives the orders of ``chat_orders`` that ``next_batch`` returns
+    records of until it returns none, one storage write per batch. Returns how many were archived.
+    """
+    archived = 0
+    while True:
+        ids = [record.id for record in await next_batch()]
+        if not ids:
+            return archived
+        async with order_locks.hold_many(ids):
+            moved = await chat_orders.archive_many(ids)
+        if not moved:
+            return archived
+        archived += len(moved)
+        # Lets the updates that came in meanwhile reach the storage first.
+        await asyncio.sleep(0)
+
+
 async def restore_order(update: Update, context: CallbackContext):
-    order_id = update.callback_query.data.split('.')[-1]
+    order_id, = context.args
     chat_id = update.callback_query.from_user.id
     message_id = update.callback_query.message.id
-    order = orders.get(int(order_id))
-    order.archived_at = None
-    orders.add(order)
+    async with order_locks.hold(order_id):
+        await orders.of(update.effective_chat.id).restore_order(order_id)
     await context.bot.delete_message(chat_id, message_id)
 
 
 async def receive_order(update: Update, context: CallbackContext):
-    order_id, received_by = update.callback_query.data.split('.')[1:]
-    order = orders.get(int(order_id))
-    order.received_at = datetime.now()
-    if received_by == 'me':
+    order_id, received_by = context.args
+
+    def receive(order: Order):
         order.received_at = datetime.now()
+        if received_by != RECEIVED_BY_ME:
+            order.received_by_customer_at = datetime.now()
+            order.status = OrderStatus.DONE
+
+    async with order_locks.hold(order_id):
+        order = await orders.of(update.effective_chat.id).update(order_id, receive)
+    if order is None:
+        await update.callback_query.message.reply_text('Замовлення не знайдено')
+        return
+
+    if received_by == RECEIVED_BY_ME:
         await display_data(
             message=update.callback_query.message,
             model=order,
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(text='Отримано клієнтом', callback_data=f'receive.{order_id}.customer')]
+                [InlineKeyboardButton(
+                    text='Отримано клієнтом', callback_data=RECEIVE(order_id, RECEIVED_BY_CUSTOMER),
+                )]
             ]),
             method='edit_text'
         )
     else:
-        order.received_at = order.received_at or datetime.now()
-        order.received_by_customer_at = datetime.now()
-        order.status = OrderStatus.DONE
         await display_data(
             message=update.callback_query.message,
             model=order,
             reply_markup=InlineKeyboardMarkup([]),
             method='edit_text'
         )
-    orders.add(order)
 
 
-async def new_orders(update: Update, context: CallbackContext):
-    _new_orders = orders.get_by_status(OrderStatus.NEW)
+PAGE_SIZE = 10
+
+# Titles and statuses of the listings, referred to by their number.
+LISTINGS = (
+    ('Нові замовлення', OrderStatus.NEW),
+    ('Замовлення у процесі', OrderStatus.IN_PROGRESS),
+    ('Виконані замовлення', OrderStatus.DONE),
+    ('Архів', None),
+)
+DONE_LISTING = next(listing for listing, (_, status) in enumerate(LISTINGS) if status == OrderStatus.DONE)
+# What can be done to the orders selected in each listing.
+BULK_OPERATIONS = (
+    {BULK_ARCHIVE: 'Архівувати'},
+    {BULK_RECEIVE: 'Отримано клієнтом', BULK_ARCHIVE: 'Архівувати'},
+    {BULK_ARCHIVE: 'Архівувати'},
+    {BULK_RESTORE: 'Відновити'},
+)
 
-    if not len(_new_orders):
-        await update.callback_query.message.reply_text('Немає заявок')
 
-    for order in _new_orders:
+def order_keyboard(order: Order) -> List[List[InlineKeyboardButton]]:
+    if order.archived_at:
+        return [[InlineKeyboardButton(text='Відновити', callback_data=RESTORE(order.id))]]
+
+    if order.status == OrderStatus.NEW:
         if all(order.products_tracking):
             reply_keyboard = [
-                [InlineKeyboardButton(text='Продовжити', callback_data=f'continue.{order.id}')],
+                [InlineKeyboardButton(text='Продовжити', callback_data=CONTINUE(order.id))],
             ]
         else:
             reply_keyboard = [
-                [InlineKeyboardButton(text='Вказати наявність ТТН', callback_data=f'fill_tracking.{order.id}')],
+                [InlineKeyboardButton(text='Вказати наявність ТТН', callback_data=FILL_TRACKING(order.id))],
             ]
+    elif order.status == OrderStatus.IN_PROGRESS:
+        reply_keyboard = [
+            [InlineKeyboardButton(text='Отримано клієнтом', callback_data=RECEIVE(order.id, RECEIVED_BY_CUSTOMER))],
+        ]
+        if not order.received_at:
+            reply_keyboard.insert(0, [
+                InlineKeyboardButton(text='Отримано мною', callback_data=RECEIVE(order.id, RECEIVED_BY_ME)),
+            ])
+    else:
+        reply_keyboard = []
 
-        reply_keyboard.append(
-            [InlineKeyboardButton(text='Архівувати', callback_data=f'archive.{order.id}')],
+    reply_keyboard.append(
+        [InlineKeyboardButton(text='Архівувати', callback_data=ARCHIVE(order.id))],
+    )
+    return reply_keyboard
+
+
+# All a listing reads, so pages skip building and validating whole orders.
+SUMMARY_FIELDS = ('id', 'created_at', 'customer_info.full_name', 'products')
+
+
+def format_summary(order) -> str:
+    created_at = order.created_at.strftime('%d.%m.%Y') if order.created_at else '—'
+    full_name = order.full_name or 'Без імені'
+    return f'{created_at} {full_name}, товарів: {len(order.products)}'
+
+
+async def show_listing(message: Message, listing: int, offset: int = 0, method='reply_text',
+                       selection: Optional[Set[int]] = None) -> None:
+    """Sends a page of the listing, in selection mode with the ids selected so far if ``selection`` is given."""
+    title, status = LISTINGS[listing]
+    chat_orders = orders.of(message.chat.id)
+    if status is None:
+        total = await chat_orders.count_archived()
+    else:
+        total = await chat_orders.count_by_status(status)
+
+    if not total:
+        await getattr(message, method)('Немає заявок')
+        return
+
+    offset = min(max(offset, 0), (total - 1) // PAGE_SIZE * PAGE_SIZE)
+    if status is None:
+        page = await chat_orders.get_archived(PAGE_SIZE, offset, SUMMARY_FIELDS)
+    else:
+        page = await chat_orders.get_by_status(status, PAGE_SIZE, offset, SUMMARY_FIELDS)
+
+    if selection is None:
+        actions = [[InlineKeyboardButton(text='Вибрати кілька', callback_data=SELECT(listing, offset))]]
+        if listing == DONE_LISTING:
+            actions.append([InlineKeyboardButton(text='Архівувати всі виконані', callback_data=ARCHIVE_DONE())])
+        await send_page(message, title, page, offset, total, lambda offset: PAGE(listing, offset), method,
+                        actions=actions)
+        return
+
+    def toggle_button(number: int, order) -> InlineKeyboardButton:
+        mark = '✅ ' if order.id in selection else ''
+        return InlineKeyboardButton(text=f'{mark}{number}', callback_data=TOGGLE(listing, offset, order.id))
+
+    actions = []
+    if selection:
+        actions.append([
+            InlineKeyboardButton(text=f'{label} ({len(selection)})', callback_data=APPLY(listing, operation))
+            for operation, label in BULK_OPERATIONS[listing].items()
+        ])
+    actions.append([InlineKeyboardButton(text='Скасувати', callback_data=PAGE(listing, offset))])
+    await send_page(message, f'{title}, вибір', page, offset, total, lambda offset: SELECT(listing, offset), method,
+                    toggle_button, actions)
+
+
+def open_button(number: int, order) -> InlineKeyboardButton:
+    return InlineKeyboardButton(text=str(number), callback_data=OPEN(order.id))
+
+
+async def send_page(message: Message, title: str, page: list, offset: int, total: int,
+                    page_callback: Callable[[int], str], method='reply_text',
+                    order_button: Callable[[int, Any], InlineKeyboardButton] = open_button,
+                    actions: List[List[InlineKeyboardButton]] = ()) -> None:
+    lines = [f'{title}: {offset + 1}–{offset + len(page)} з {total}', '']
+    buttons = []
+    for number, order in enumerate(page, offset + 1):
+        button = order_button(number, order)
+        lines.append(f'{button.text}. {format_summary(order)}')
+        buttons.append(button)
+
+    reply_keyboard = [buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+    navigation = []
+    if offset > 0:
+        navigation.append(InlineKeyboardButton(text='◀️', callback_data=page_callback(offset - PAGE_SIZE)))
+    if offset + PAGE_SIZE < total:
+        navigation.append(InlineKeyboardButton(text='▶️', callback_data=page_callback(offset + PAGE_SIZE)))
+    if navigation:
+        reply_keyboard.append(navigation)
+    reply_keyboard.extend(actions)
+
+    await getattr(message, method)('\n'.join(lines), reply_markup=InlineKeyboardMarkup(reply_keyboard))
+
+
+async def list_orders(update: Update, context: CallbackContext):
+    listing, = context.args
+    await show_listing(update.callback_query.message, listing)
+
+
+async def turn_page(update: Update, context: CallbackContext):
+    listing, offset = context.args
+    await show_listing(update.callback_query.message, listing, offset, method='edit_text')
+
+
+def back_to_listing(listing: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text='До списку', callback_data=PAGE(listing, 0))]])
+
+
+async def select_orders(update: Update, context: CallbackContext):
+    session = sessions.get(update.effective_chat.id)
+    if session is None:
+        return await ask_password(update.callback_query.message)
+    listing, offset, *toggled = context.args
+    if session.selected_listing != listing:
+        session.selected = set()
+        session.selected_listing = listing
+    session.selected.symmetric_difference_update(toggled)
+    await show_listing(update.callback_query.message, listing, offset, 'edit_text', session.selected)
+    return MENU
+
+
+async def apply_to_selected(update: Update, context: CallbackContext):
+    session = sessions.get(update.effective_chat.id)
+    if session is None:
+        return await ask_password(update.callback_query.message)
+    listing, operation = context.args
+    message = update.callback_query.message
+    ids = sorted(session.selected) if session.selected_listing == listing else []
+    title = BULK_OPERATIONS[listing].get(operation)
+    if not ids or title is None:
+        await message.reply_text('Нічого не вибрано')
+        return MENU
+
+    # All of them with one storage write, then one message about it.
+    chat_orders = orders.of(update.effective_chat.id)
+    async with order_locks.hold_many(ids):
+        if operation == BULK_ARCHIVE:
+            changed = await chat_orders.archive_many(ids)
+        elif operation == BULK_RESTORE:
+            changed = await chat_orders.restore_many(ids)
+        else:
+            changed = await chat_orders.update_status_many(ids, OrderStatus.DONE)
+    session.selected = set()
+    session.selected_listing = None
+    await message.edit_text(f'{title}: {len(changed)} з {len(ids)} замовл.', reply_markup=back_to_listing(listing))
+    return MENU
+
+
+async def archive_done_orders(update: Update, context: CallbackContext):
+    session = sessions.get(update.effective_chat.id)
+    if session is None:
+        return await ask_password(update.callback_query.message)
+    message = update.callback_query.message
+    chat_orders = orders.of(update.effective_chat.id)
+    if not context.args:
+        total = await chat_orders.count_by_status(OrderStatus.DONE)
+        await message.edit_text(
+            f'Архівувати всі виконані замовлення ({total})?',
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton(text='Так', callback_data=ARCHIVE_DONE(1)),
+                InlineKeyboardButton(text='Ні', callback_data=PAGE(DONE_LISTING, 0)),
+            ]]),
         )
+        return MENU
 
-        await display_data(
-            update.callback_query.message, order,
-            reply_markup=InlineKeyboardMarkup(
-                reply_keyboard,
-            ),
+    archived = await archive_in_batches(
+        chat_orders, lambda: chat_orders.get_by_status(OrderStatus.DONE, ARCHIVE_BATCH_SIZE, fields=('id',))
+    )
+    await message.edit_text(f'Архівовано виконаних замовлень: {archived}', reply_markup=back_to_listing(DONE_LISTING))
+    return MENU
+
+
+async def show_search(message: Message, query: str, offset: int = 0, method='reply_text') -> None:
+    total, page = await orders.of(message.chat.id).search(query, PAGE_SIZE, max(offset, 0), SUMMARY_FIELDS)
+    if not page:
+        await getattr(message, method)(f'За запитом «{query}» нічого не знайдено')
+        return
+    await send_page(message, f'Пошук «{query}»', page, max(offset, 0), total, SEARCH_PAGE, method)
+
+
+async def search_orders(update: Update, context: CallbackContext):
+    session = sessions.get(update.effective_chat.id)
+    if session is None:
+        return await ask_password(update.message)
+    query = ' '.join(context.args or [])
+    if not query:
+        await update.message.reply_text("Напишіть, що шукати: /search ім'я, телефон, адреса, товар або магазин")
+        return MENU
+    session.query = query
+    await show_search(update.message, query)
+    return MENU
+
+
+async def turn_search_page(update: Update, context: CallbackContext):
+    session = sessions.get(update.effective_chat.id)
+    if session is None:
+        return await ask_password(update.callback_query.message)
+    if not session.query:
+        await update.callback_query.message.reply_text('Пошук застарів, повторіть /search')
+        return MENU
+    offset, = context.args
+    await show_search(update.callback_query.message, session.query, offset, method='edit_text')
+    return MENU
+
+
+STATUS_TITLES = {
+    OrderStatus.NEW.value: 'Нові',
+    OrderStatus.IN_PROGRESS.value: 'У процесі',
+    OrderStatus.DONE.value: 'Виконані',
+    ARCHIVED: 'Архів',
+}
+STATS_MONTHS = 6
+
+
+def format_money(amount: Decimal) -> str:
+    return f'{amount:,.2f}'.replace(',', '\u00a0').replace('.', ',')
+
+
+def format_totals(totals: Totals) -> str:
+    return (
+        f'{totals.orders} замовл., скинули {format_money(totals.income)}, '
+        f'товари {format_money(totals.price)}, доставка {format_money(totals.delivery_price)}, '
+        f'комісія {format_money(totals.service_fee)}'
+    )
+
+
+async def show_stats(update: Update, context: CallbackContext):
+    session = sessions.get(update.effective_chat.id)
+    if session is None:
+        return await ask_password(update.message)
+
+    # Only the running totals are read, however many orders there are.
+    today = datetime.now().date()
+    chat_orders = orders.of(update.effective_chat.id)
+    week = await chat_orders.get_stats(DAY, (today - timedelta(days=6)).isoformat(), today.isoformat())
+    first_month = today.year * 12 + today.month - STATS_MONTHS
+    months = await chat_orders.get_stats(MONTH, f'{first_month // 12}-{first_month % 12 + 1:02d}', today.strftime('%Y-%m'))
+    statuses = dict(await chat_orders.get_stats(STATUS))
+
+    lines = [
+        'Статистика за датою створення',
+        '',
+        f'Сьогодні: {format_totals(dict(week).get(today.isoformat(), Totals()))}',
+        f'За 7 днів: {format_totals(sum((totals for _, totals in week), Totals()))}',
+        '',
+        'За місяцями:',
+    ]
+    lines.extend(f'{month[5:]}.{month[:4]}: {format_totals(totals)}' for month, totals in reversed(months))
+    lines.extend(['', 'За статусами:'])
+    lines.extend(
+        f'{title}: {format_totals(statuses[status])}'
+        for status, title in STATUS_TITLES.items() if status in statuses
+    )
+    await update.message.reply_text('\n'.join(lines))
+    return MENU
+
+
+EXPORT_USAGE = (
+    'Використання: /export [csv|jsonl] [new|in_progress|done] [archived|live] [період]\n'
+    'Період: 2024-03-05, 2024-03 або 2024-01..2024-03. Без фільтрів вивантажуються всі замовлення.'
+)
+
+
+async def export_orders(update: Update, context: CallbackContext):
+    session = sessions.get(update.effective_chat.id)
+    if session is None:
+        return await ask_password(update.message)
+
+    fmt, statuses, archived, period = 'csv', set(), INCLUDE, (None, None)
+    for arg in context.args or []:
+        if arg in FORMATS:
+            fmt = arg
+        elif arg in {status.value for status in OrderStatus}:
+            statuses.add(OrderStatus(arg))
+        elif arg in ('archived', 'live'):
+            archived = ONLY if arg == 'archived' else EXCLUDE
+        else:
+            try:
+                period = parse_period(arg)
+            except ValueError:
+                await update.message.reply_text(EXPORT_USAGE)
+                return MENU
+
+    # Written a batch at a time, so only one batch of orders is in memory.
+    with tempfile.TemporaryFile() as f:
+        text = io.TextIOWrapper(f, encoding='utf-8-sig' if fmt == 'csv' else 'utf-8', newline='')
+        write = row_writer(text, fmt)
+        count = 0
+        async for batch in orders.of(update.effective_chat.id).stream(export_batches, statuses or None, archived, period):
+            write(batch)
+            count += len(batch)
+        text.flush()
+        text.detach()
+        if not count:
+            await update.message.reply_text('Немає замовлень для вивантаження')
+            return MENU
+        f.seek(0)
+        await update.message.reply_document(
+            f, filename=f'orders-{datetime.now():%Y-%m-%d}.{fmt}', caption=f'Замовлень: {count}',
         )
+    return MENU
+
+
+async def open_order(update: Update, context: CallbackContext):
+    order_id, = context.args
+    order = await orders.of(update.effective_chat.id).get(order_id)
+    if order is None:
+        await update.callback_query.message.reply_text('Замовлення не знайдено')
+        return
+
+    await display_data(
+        update.callback_query.message, order,
+        reply_markup=InlineKeyboardMarkup(
+            order_keyboard(order),
+        ),
+    )
 
 
 async def continue_filling(update: Update, context: CallbackContext):
-    user_id = str(update.callback_query.from_user.id)
-    current_models[user_id] = InProgressOrder
-    order_id = update.callback_query.data.split('.')[1]
-    data = orders.get(int(order_id)).model_dump()
+    session = sessions.get(update.effective_chat.id)
+    if session is None:
+        return await ask_password(update.callback_query.message)
+    session.form = InProgressOrder
+    order_id, = context.args
+    data = (await orders.of(update.effective_chat.id).get(order_id)).model_dump()
     data['status'] = OrderStatus.IN_PROGRESS
-    user_data[user_id] = InProgressOrder(**data).model_dump(
+    session.answers = InProgressOrder(**data).model_dump(
         exclude_none=True,
         exclude_unset=True,
         exclude_defaults=True
@@ -309,109 +716,120 @@ async def continue_filling(update: Update, context: CallbackContext):
 
 
 async def add_order(update: Update, context: CallbackContext):
-    user_id = str(update.callback_query.from_user.id)
-    current_models[user_id] = NewOrder
+    session = sessions.get(update.effective_chat.id)
+    if session is None:
+        return await ask_password(update.callback_query.message)
+    session.form = NewOrder
     return await next_field(update, context)
 
 
 async def next_field(update: Update, context: CallbackContext) -> int:
     if update.callback_query:
         message = update.callback_query.message
-        user_id = str(update.callback_query.message.chat.id)
     else:
         message = update.message
-        user_id = str(update.message.chat.id)
-
-    current_model = current_models[user_id](**unflatten_dict(user_data[user_id]))
-    for field, prompt in generate_field_mapping(get_type_hints(current_models[user_id]), model=current_models[user_id]).items():
-        if field not in user_data[user_id]:
-            if is_list_field(field, current_models[user_id]):
-                user_data[user_id][field] = []
-            else:
-                user_data[user_id][field] = None
-            await message.reply_text(prompt)
-            return SELECTING_FIELD
-
-    if current_models[user_id] is NewOrder:
+    session = sessions.get(update.effective_chat.id)
+    if session is None or session.form is None:
+        return await ask_password(message) if session is None else MENU
+
+    schema = get_form_schema(session.form)
+    field = schema.next_field(session.answers)
+    if field is not None:
+        session.answers[field.path] = [] if field.is_list else None
+        await message.reply_text(field.prompt)
+        return SELECTING_FIELD
+
+    current_model = schema.build(session.answers)
+    session.form = None
+    session.answers = {}
+    chat_orders = orders.of(update.effective_chat.id)
+    if isinstance(current_model, NewOrder):
         order = Order(**current_model.model_dump())
         order.products_tracking = [False] * len(order.products)
+        await chat_orders.add(order)
     else:
-        order = Order(**{**orders.get(current_model.id).model_dump(), **current_model.model_dump()})
-    orders.add(order)
+        changes = current_model.model_dump()
 
-    await display_data(message, order)
-    del current_models[user_id]
-    user_data[user_id] = {}
-    return MENU
+        def apply_changes(order: Order):
+            for name, value in changes.items():
+                setattr(order, name, value)
+                # The amount typed now replaces the text it could not be parsed from.
+                order.unparsed_amounts.pop(name, None)
 
+        async with order_locks.hold(current_model.id):
+            order = await chat_orders.update(current_model.id, apply_changes)
+        if order is None:
+            await message.reply_text('Замовлення не знайдено')
+            return MENU
 
-def is_list_field(field_name: str, model: Type[BaseModel]) -> bool:
-    return get_type_hints(model).get(field_name) == List[str]
+    await display_data(message, order)
+    return MENU
 
 
 async def handle_text(update: Update, context: CallbackContext) -> int:
-    user_id = str(update.message.chat.id)
+    session = sessions.get(update.effective_chat.id)
+    if session is None:
+        return await ask_password(update.message)
     user_input = update.message.text
-    current_field = list(user_data[user_id].keys())[-1]
-    if current_field:
-        if is_list_field(current_field, current_models[user_id]):
-            user_data[user_id][current_field].append(user_input)
+    current_field = next(reversed(session.answers), None)
+    if current_field and session.form is not None:
+        field = get_form_schema(session.form).field(current_field)
+        if field.is_list:
+            session.answers[current_field].append(user_input)
             await update.message.reply_text("Додано! Додайте ще, або напишіть /skip для завершення.")
             return ADDING_LIST_ITEM
-        user_data[user_id][current_field] = user_input
+        if field.parse is not None:
+            try:
+                user_input = field.parse(user_input)
+            except AmbiguousAmountError:
+                await update.message.reply_text(
+                    'Незрозуміло, це тисячі чи копійки. Напишіть, наприклад, 1000 або 1 000 чи 1,00'
+                )
+                return SELECTING_FIELD
+            except ValueError:
+                await update.message.reply_text('Не вдалося розібрати суму, напишіть число, наприклад 1250,50')
+                return SELECTING_FIELD
+        session.answers[current_field] = user_input
         return await next_field(update, context)
 
     return MENU
 
 
 async def handle_list_item(update: Update, context: CallbackContext) -> int:
-    user_id = str(update.message.chat.id)
+    session = sessions.get(update.effective_chat.id)
+    if session is None:
+        return await ask_password(update.message)
     user_input = update.message.text
-    current_field = list(user_data[user_id].keys())[-1]
+    current_field = next(reversed(session.answers))
 
     # Stay in the same state to keep adding list items
     if user_input.lower() != "/skip":
-        user_data[user_id][current_field].append(user_input)
+        session.answers[current_field].append(user_input)
         await update.message.reply_text("Додано! Додайте ще, або напишіть /skip для завершення.")
         return ADDING_LIST_ITEM
     else:
         return await next_field(update, context)
 
 
-def format_model(model):
-    result = ""
-    for field_name, field in model.model_fields.items():
-        attr = getattr(model, field_name)
-
-        if field_name in ['products_tracking']:
-            continue
-        elif field_name == 'products':
-            products = [
-                (
-                    escape_markdown(p) + '\t\t\t(є ТТН)'
-                    if next(iter(getattr(model, 'products_tracking')[i:i+1]), None)
-                    else escape_markdown(p)
-                )
-                for i, p in enumerate(attr)
-            ]
-            attr = '\n\t\t' + '\n\t\t'.join(products)
-
-        if isinstance(attr, BaseModel):
-            attr = '\n\t\t' + '\t\t'.join(format_model(attr).splitlines(True))
-            attr = attr.rstrip('\n')
-        elif isinstance(attr, list):
-            attr = '\n\t\t' + escape_markdown('\n\t\t'.join(attr))
-        else:
-            attr = str(attr)
-            attr = escape_markdown(attr, version=2)
-        result += f"*{field.title}*: {attr}\n"
-    return result
-
+async def stale_button(update: Update, context: CallbackContext):
+    await update.callback_query.message.reply_text('Ця кнопка застаріла, відкрийте меню знову: /start')
 
-async def display_data(message: Message, model: BaseModel, method='reply_text', **kwargs) -> None:
-    formatted = format_model(model)
-    await getattr(message, method)(f"{formatted}", parse_mode='MarkdownV2', **kwargs)
 
+callback_router = CallbackRouter()
+callback_router.route(ADD_ORDER, add_order)
+callback_router.route(LIST, list_orders)
+callback_router.route(PAGE, turn_page)
+callback_router.route(OPEN, open_order)
+callback_router.route(RECEIVE, receive_order)
+callback_router.route(CONTINUE, continue_filling)
+callback_router.route(FILL_TRACKING, fill_tracking)
+callback_router.route(ARCHIVE, archive_order)
+callback_router.route(RESTORE, restore_order)
+callback_router.route(SEARCH_PAGE, turn_search_page)
+callback_router.route(SELECT, select_orders)
+callback_router.route(TOGGLE, select_orders)
+callback_router.route(APPLY, apply_to_selected)
+callback_router.route(ARCHIVE_DONE, archive_done_orders)
 
 conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -419,19 +837,16 @@ conv_handler = ConversationHandler(
             SELECTING_FIELD: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text), CommandHandler("start", start)],
             ADDING_LIST_ITEM: [MessageHandler(filters.TEXT, handle_list_item), CommandHandler("start", start)],
             MENU: [
-                CallbackQueryHandler(new_orders, 'new_orders'),
-                CallbackQueryHandler(done_orders, 'done_orders'),
-                CallbackQueryHandler(in_progress_orders, 'in_progress_orders'),
-                CallbackQueryHandler(receive_order, 'receive.*'),
-                CallbackQueryHandler(add_order, 'add_order'),
-                CallbackQueryHandler(continue_filling, 'continue.*'),
-                CallbackQueryHandler(fill_tracking, 'fill_tracking.*'),
-                CallbackQueryHandler(archived_orders, 'archived_orders'),
-                CallbackQueryHandler(archive_order, 'archive.*'),
-                CallbackQueryHandler(restore_order, 'restore.*'),
+                callback_router,
+                CallbackQueryHandler(stale_button),
+                CommandHandler("search", search_orders),
+                CommandHandler("stats", show_stats),
+                CommandHandler("export", export_orders),
                 CommandHandler("start", start)
             ],
             PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_password)]
         },
         fallbacks=[],
+        name='orders',
+        persistent=True,
     )
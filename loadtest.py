@@ -0,0 +1,441 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import signal
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+from bench import OrderGenerator, populate
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [1_000, 10_000]
+DEFAULT_CONCURRENCY = [1, 4, 16]
+TOKEN = '123456:loadtest'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Load test', 'username': 'load_test_bot'}
+# Bot API methods that answer the chat an update came from.
+REPLY_METHODS = frozenset({'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'deleteMessage'})
+
+
+class FakeBotAPI:
+    """
+    Just enough of the Bot API on localhost for the bot to poll it.
+
+    Updates pushed by the simulated chats are served to ``getUpdates``, and
+    each message the bot sends, edits or deletes resolves the reply its
+    chat is waiting for. Every call is counted by method.
+    """
+
+    def __init__(self):
+        self.calls: Counter = Counter()
+        self.unexpected = 0
+        self.polling = asyncio.Event()
+        self._updates: Deque[dict] = deque()
+        self._new_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1_000_000)
+        self._waiting: Dict[int, asyncio.Future] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections = set()
+
+    async def start(self, host: str = '127.0.0.1') -> str:
+        """Returns the base URL to give the bot."""
+        self._server = await asyncio.start_server(self._serve, host, 0)
+        port = self._server.sockets[0].getsockname()[1]
+        return f'http://{host}:{port}/bot'
+
+    async def stop(self):
+        self._server.close()
+        # Long polls still waiting return, so their connections can close.
+        self._new_updates.set()
+        await asyncio.gather(*self._connections)
+        await self._server.wait_closed()
+
+    def push(self, chat_id: int, update: dict) -> asyncio.Future:
+        """Queues an update from ``chat_id`` and returns the future of the bot's reply to it."""
+        reply = asyncio.get_running_loop().create_future()
+        self._waiting[chat_id] = reply
+        self._updates.append({'update_id': next(self._update_ids), **update})
+        self._new_updates.set()
+        return reply
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # HTTP/1.1 with keep-alive, as much of it as httpx uses.
+        self._connections.add(asyncio.current_task())
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                path = request_line.split()[1].decode('ascii')
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, _, value = line.partition(b':')
+                    if name.strip().lower() == b'content-length':
+                        length = int(value)
+                body = await reader.readexactly(length)
+                params = dict(parse_qsl(body.decode('utf-8')))
+                result = await self._call(path.rpartition('/')[2], params)
+                payload = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+                writer.write(
+                    b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                    b'Content-Length: %d\r\n\r\n%s' % (len(payload), payload)
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            self._connections.discard(asyncio.current_task())
+
+    async def _call(self, method: str, params: Dict[str, str]) -> Any:
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return await self._get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)))
+        if method == 'getMe':
+            return BOT_USER
+        if method not in REPLY_METHODS:
+            return True
+
+        chat_id = int(params['chat_id'])
+        if method == 'deleteMessage':
+            result = True
+            message_id = int(params['message_id'])
+        else:
+            message_id = int(params['message_id']) if 'message_id' in params else next(self._message_ids)
+            result = {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        reply = self._waiting.pop(chat_id, None)
+        if reply is None or reply.done():
+            # A second message for one update, or one after the chat gave up on it.
+            self.unexpected += 1
+        else:
+            reply.set_result((method, params, message_id))
+        return result
+
+    async def _get_updates(self, offset: int, timeout: float) -> List[dict]:
+        self.polling.set()
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft()
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, 100))
+
+
+class Pacer:
+    """Spaces calls to ``wait`` ``1 / rate`` seconds apart across all chats, or not at all without a rate."""
+
+    def __init__(self, rate: Optional[float]):
+        self._interval = 1 / rate if rate else 0
+        self._next = time.monotonic()
+
+    async def wait(self):
+        if not self._interval:
+            return
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + self._interval
+        await asyncio.sleep(slot - now)
+
+
+class SimulatedChat:
+    """
+    A private chat that sends an update and waits for the bot to answer it
+    before sending the next, pressing the buttons of the latest answer.
+    """
+
+    # Message and callback query ids, unique across chats.
+    ids = itertools.count(1)
+
+    def __init__(self, api: FakeBotAPI, chat_id: int, pacer: Pacer, timeout: float, rng: random.Random):
+        self.id = chat_id
+        self.latencies: List[int] = []
+        self.timeouts = 0
+        self._api = api
+        self._pacer = pacer
+        self._timeout = timeout
+        self._rng = rng
+        self._message_id = 0
+        self._buttons: List[str] = []
+        self._user = {'id': chat_id, 'is_bot': False, 'first_name': f'Load {chat_id}'}
+
+    async def send(self, text: str):
+        message = self._message(text)
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        await self._update({'message': message})
+
+    async def press(self, prefix: str) -> bool:
+        """
+        Presses one of the buttons whose callback data starts with
+        ``prefix``, returns ``False`` if the latest answer has none.
+        """
+        buttons = [data for data in self._buttons if data.startswith(prefix)]
+        if not buttons:
+            return False
+        await self._update({'callback_query': {
+            'id': str(next(self.ids)),
+            'from': self._user,
+            'chat_instance': str(self.id),
+            'data': self._rng.choice(buttons),
+            'message': self._message('', self._message_id),
+        }})
+        return True
+
+    def _message(self, text: str, message_id: Optional[int] = None) -> dict:
+        return {
+            'message_id': message_id or next(self.ids),
+            'date': int(time.time()),
+            'chat': {'id': self.id, 'type': 'private'},
+            'from': self._user,
+            'text': text,
+        }
+
+    async def _update(self, body: dict):
+        await self._pacer.wait()
+        begin = time.perf_counter_ns()
+        reply = self._api.push(self.id, body)
+        try:
+            method, params, message_id = await asyncio.wait_for(reply, self._timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._buttons = []
+            return
+        self.latencies.append(time.perf_counter_ns() - begin)
+        self._message_id = message_id
+        markup = json.loads(params.get('reply_markup') or '{}')
+        self._buttons = [
+            button['callback_data'] for row in markup.get('inline_keyboard', []) for button in row
+            if 'callback_data' in button
+        ]
+
+
+async def scenario(chat: SimulatedChat, generator: OrderGenerator):
+    """One round of the daily routine: add an order, then work the new and in-progress listings."""
+    import handlers
+    from model import NewOrder
+
+    await chat.send('/start')
+    await chat.press(handlers.ADD_ORDER())
+    values = generator.order().model_dump()
+    for field in handlers.get_form_schema(NewOrder).fields:
+        value = values
+        for key in field.path.split('.'):
+            value = value[key]
+        if not field.is_list:
+            await chat.send(str(value))
+            continue
+        for item in value:
+            await chat.send(item)
+        await chat.send('/skip')
+
+    await chat.send('/start')
+    if await chat.press(handlers.LIST(0)) and await chat.press(handlers.OPEN.code):
+        if await chat.press(handlers.FILL_TRACKING.code):
+            while await chat.press(handlers.FILL_TRACKING.code):
+                pass
+
+    await chat.send('/start')
+    if await chat.press(handlers.LIST(1)) and await chat.press(handlers.OPEN.code):
+        while await chat.press(handlers.RECEIVE.code):
+            pass
+
+
+def summarize(chats: List[SimulatedChat], api: FakeBotAPI, elapsed: float) -> dict:
+    latencies = sorted(latency for chat in chats for latency in chat.latencies)
+    updates = len(latencies) + sum(chat.timeouts for chat in chats)
+    replies = sum(count for method, count in api.calls.items() if method != 'getUpdates')
+
+    def percentile(q: float) -> Optional[float]:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q))] / 1e6 if latencies else None
+
+    return {
+        'updates': updates,
+        'timeouts': sum(chat.timeouts for chat in chats),
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'p50_ms': percentile(0.5),
+        'p90_ms': percentile(0.9),
+        'p99_ms': percentile(0.99),
+        'max_ms': latencies[-1] / 1e6 if latencies else None,
+        'mean_ms': statistics.fmean(latencies) / 1e6 if latencies else None,
+        'api_calls_per_update': replies / updates if updates else None,
+        'api_calls': dict(api.calls),
+        'unexpected_replies': api.unexpected,
+    }
+
+
+async def load(workdir: str, backend: str, concurrency: int, rate: Optional[float], args) -> dict:
+    """Runs the bot from ``workdir`` against a fake Bot API and drives it with ``args.chats`` chats."""
+    api = FakeBotAPI()
+    base_url = await api.start()
+    env = {
+        **os.environ,
+        'BOT_TOKEN': TOKEN,
+        'DB_BACKEND': backend,
+        'DB_STORAGE': args.storage,
+        'DB_CODEC': args.codec,
+    }
+    command = [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'),
+        '--base-url', base_url, '--concurrent-updates', str(concurrency),
+    ]
+    if not args.flood_control:
+        command.append('--no-flood-control')
+    if args.pool_size:
+        command.extend(['--pool-size', str(args.pool_size)])
+    with open(os.path.join(workdir, 'bot.log'), 'wb') as log:
+        process = await asyncio.create_subprocess_exec(
+            *command, cwd=workdir, env=env, stdout=log, stderr=log,
+        )
+    try:
+        await asyncio.wait_for(api.polling.wait(), args.startup_timeout)
+        startup = dict(api.calls)
+        api.calls.clear()
+
+        pacer = Pacer(rate)
+        deadline = time.monotonic() + args.duration
+        chats = [
+            SimulatedChat(api, chat_id, pacer, args.reply_timeout, random.Random(args.seed + chat_id))
+            for chat_id in range(1, args.chats + 1)
+        ]
+
+        async def run_chat(chat: SimulatedChat):
+            generator = OrderGenerator(args.seed + chat.id)
+            await chat.send('/start')
+            await chat.send(datetime.now().strftime('%d*%m*%Y'))
+            while time.monotonic() < deadline:
+                await scenario(chat, generator)
+
+        started = time.perf_counter()
+        await asyncio.gather(*map(run_chat, chats))
+        elapsed = time.perf_counter() - started
+        # The chats only stop between rounds, so updates in flight are all answered.
+        api.calls.pop('getUpdates', None)
+        result = summarize(chats, api, elapsed)
+        result['startup_calls'] = startup
+        return result
+    except asyncio.TimeoutError:
+        raise RuntimeError(f'The bot did not start polling, see {os.path.join(workdir, "bot.log")}') from None
+    finally:
+        if process.returncode is None:
+            process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(process.wait(), 30)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        await api.stop()
+
+
+def run(args) -> dict:
+    results = []
+    generator = OrderGenerator(args.seed)
+    all_orders = []
+    for size in sorted(args.sizes):
+        all_orders.extend(generator.orders(size - len(all_orders)))
+        for backend in args.backends:
+            template = tempfile.mkdtemp(prefix=f'loadtest-{backend}-{size}-', dir=args.workdir)
+            begin = time.perf_counter()
+            populate(backend, all_orders[:size], template, args.storage, args.codec)
+            logger.info('Populated %s with %s orders in %.1fs', backend, size, time.perf_counter() - begin)
+
+            for concurrency, rate in itertools.product(args.concurrency, args.rates or [None]):
+                # Every run starts from the same orders.
+                workdir = f'{template}-c{concurrency}-r{rate or "max"}'
+                shutil.copytree(template, workdir)
+                result = asyncio.run(load(workdir, backend, concurrency, rate, args))
+                results.append({
+                    'size': size, 'backend': backend, 'concurrency': concurrency, 'rate': rate,
+                    'chats': args.chats, **result,
+                })
+                logger.info(
+                    '%8d %-7s c=%-3d rate %-6s %8.1f updates/s  p50 %8.1f ms  p99 %8.1f ms  '
+                    '%5.2f calls/update  %d timeouts',
+                    size, backend, concurrency, rate or 'max', result['throughput'] or 0,
+                    result['p50_ms'] or 0, result['p99_ms'] or 0, result['api_calls_per_update'] or 0,
+                    result['timeouts'],
+                )
+    return {
+        'meta': {
+            'created_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'chats': args.chats,
+            'duration': args.duration,
+            'storage': args.storage,
+            'codec': args.codec,
+            'flood_control': args.flood_control,
+        },
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the bot against a local fake Bot API and replay conversations from many chats'
+    )
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Orders stored before each run')
+    parser.add_argument('--backends', nargs='+', choices=['tinydb', 'sqlite'], default=['sqlite'])
+    parser.add_argument('--storage', choices=['json', 'wal'], default='wal', help='TinyDB storage')
+    parser.add_argument('--codec', choices=['json', 'msgpack'], default='json', help='TinyDB codec')
+    parser.add_argument(
+        '--concurrency', type=int, nargs='+', default=DEFAULT_CONCURRENCY,
+        help='Values of --concurrent-updates to run the bot with',
+    )
+    parser.add_argument(
+        '--rates', type=float, nargs='+', default=None,
+        help='Updates per second sent by all chats together, as fast as the bot answers if not given',
+    )
+    parser.add_argument('--chats', type=int, default=50, help='Simulated chats')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds the chats keep starting new rounds')
+    parser.add_argument('--reply-timeout', type=float, default=10, help='Seconds a chat waits for an answer')
+    parser.add_argument('--startup-timeout', type=float, default=120, help='Seconds the bot may take to start')
+    parser.add_argument('--pool-size', type=int, default=None, help='Passed on to the bot')
+    parser.add_argument(
+        '--flood-control', action='store_true',
+        help="Keep the bot's flood limits, which cap it at about 30 messages per second",
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help='Where to create the bot working directories')
+    parser.add_argument('-o', '--output', default='loadtest_results.json')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # Shards open lazily, so importing handlers touches no files, but anything
+    # written to relative paths still lands in a scratch directory.
+    args.output = os.path.abspath(args.output)
+    args.workdir = args.workdir and os.path.abspath(args.workdir)
+    os.chdir(tempfile.mkdtemp(prefix='loadtest-', dir=args.workdir))
+
+    report = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info('Saved results to %s', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,24 @@
 import argparse
 import logging
+from datetime import timedelta
 
-from telegram.ext import ApplicationBuilder, CommandHandler
+from telegram.ext import Application, ApplicationBuilder, CommandHandler
 
 import env
-from handlers import start, conv_handler
+import metrics
+from concurrency import PerChatUpdateProcessor
+from outbound import FloodControlRateLimiter, PassThroughRateLimiter
+from sessions import SessionPersistence
+from handlers import start, conv_handler, orders, sessions
+from retention import schedule_archiving
 
 TOKEN = env.get('BOT_TOKEN')
 
 
+async def close_storage(app: Application):
+    await orders.close()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -22,15 +32,151 @@ def main():
         help="Be verbose",
         action="store_const", dest="loglevel", const=logging.INFO,
     )
+    parser.add_argument(
+        '-c', '--concurrent-updates',
+        help="How many chats to process updates for at the same time",
+        type=int, default=env.get('CONCURRENT_UPDATES', int, 1),
+    )
+    parser.add_argument(
+        '--pool-size',
+        help="Size of the HTTP connection pool used for Bot API requests",
+        type=int, default=env.get('CONNECTION_POOL_SIZE', int, None),
+    )
+    parser.add_argument(
+        '--base-url',
+        help="Bot API URL the token is appended to, e.g. of a local Bot API server",
+        default=env.get('BOT_API_URL', default=None),
+    )
+    parser.add_argument(
+        '--no-flood-control',
+        help="Send Bot API requests as they come instead of within Telegram's flood limits",
+        action='store_false', dest='flood_control',
+    )
+    webhook = parser.add_argument_group(
+        'webhook',
+        'Receive updates through a webhook instead of long polling. '
+        'Enabled by setting the public URL Telegram should post updates to.',
+    )
+    webhook.add_argument(
+        '--webhook-url',
+        help="Public URL of the webhook, usually served by a reverse proxy",
+        default=env.get('WEBHOOK_URL', default=None),
+    )
+    webhook.add_argument(
+        '--listen',
+        help="Address the webhook server listens on",
+        default=env.get('WEBHOOK_LISTEN', default='127.0.0.1'),
+    )
+    webhook.add_argument(
+        '--port',
+        help="Port the webhook server listens on",
+        type=int, default=env.get('WEBHOOK_PORT', int, 8443),
+    )
+    webhook.add_argument(
+        '--url-path',
+        help="Path the webhook server accepts updates on",
+        default=env.get('WEBHOOK_PATH', default=''),
+    )
+    webhook.add_argument(
+        '--secret-token',
+        help="Secret Telegram sends in the X-Telegram-Bot-Api-Secret-Token header",
+        default=env.get('WEBHOOK_SECRET', default=None),
+    )
+    monitoring = parser.add_argument_group(
+        'metrics',
+        'Record handler, storage and Bot API latencies. Off unless a port or a log interval is set.',
+    )
+    monitoring.add_argument(
+        '--metrics-port',
+        help="Serve Prometheus metrics on this port at /metrics",
+        type=int, default=env.get('METRICS_PORT', int, None),
+    )
+    monitoring.add_argument(
+        '--metrics-listen',
+        help="Address the metrics server listens on",
+        default=env.get('METRICS_LISTEN', default='127.0.0.1'),
+    )
+    monitoring.add_argument(
+        '--metrics-log-interval',
+        help="Log a metrics summary every this many seconds",
+        type=float, default=env.get('METRICS_LOG_INTERVAL', float, None),
+    )
+    archiving = parser.add_argument_group(
+        'auto-archive',
+        'Archive done orders some time after the customer received them. Off unless an age is set.',
+    )
+    archiving.add_argument(
+        '--archive-after-days',
+        help="Archive done orders received by the customer this many days ago",
+        type=float, default=env.get('ARCHIVE_AFTER_DAYS', float, None),
+    )
+    archiving.add_argument(
+        '--archive-interval',
+        help="Look for orders to archive every this many seconds",
+        type=float, default=env.get('ARCHIVE_INTERVAL', float, 3600),
+    )
+    archiving.add_argument(
+        '--archive-batch-size',
+        help="Orders archived with one storage write",
+        type=int, default=env.get('ARCHIVE_BATCH_SIZE', int, 100),
+    )
     args = parser.parse_args()
     logging.basicConfig(level=args.loglevel)
 
+    rate_limiter = FloodControlRateLimiter() if args.flood_control else None
+    with_metrics = bool(args.metrics_port or args.metrics_log_interval)
+    if with_metrics:
+        orders.on_open(metrics.instrument_repository)
+        if rate_limiter is None:
+            # Bot API requests are timed where they pass the rate limiter.
+            rate_limiter = PassThroughRateLimiter()
+        metrics.instrument_rate_limiter(rate_limiter)
+        if args.metrics_port:
+            metrics.serve(args.metrics_listen, args.metrics_port)
+        if args.metrics_log_interval:
+            metrics.log_periodically(args.metrics_log_interval)
+
     # Initialize the bot
-    app = ApplicationBuilder().token(TOKEN).build()
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .persistence(SessionPersistence(
+            sessions,
+            env.get('STATE_PATH', default='state.pickle'),
+            update_interval=env.get('STATE_FLUSH_INTERVAL', float, 60),
+        ))
+        .post_shutdown(close_storage)
+    )
+    if rate_limiter is not None:
+        builder.rate_limiter(rate_limiter)
+    if args.base_url:
+        builder.base_url(args.base_url)
+    if args.concurrent_updates > 1:
+        builder.concurrent_updates(PerChatUpdateProcessor(args.concurrent_updates))
+    if args.pool_size:
+        builder.connection_pool_size(args.pool_size)
+    app = builder.build()
 
     app.add_handler(conv_handler)
     app.add_handler(CommandHandler("start", start))
-    app.run_polling()
+    if with_metrics:
+        metrics.instrument_application(app)
+    if args.archive_after_days is not None:
+        if app.job_queue is None:
+            parser.error('auto-archive needs the job queue: pip install "python-telegram-bot[job-queue]"')
+        schedule_archiving(
+            app.job_queue, timedelta(days=args.archive_after_days), args.archive_interval, args.archive_batch_size,
+        )
+    if args.webhook_url:
+        app.run_webhook(
+            listen=args.listen,
+            port=args.port,
+            url_path=args.url_path,
+            secret_token=args.secret_token,
+            webhook_url=args.webhook_url,
+        )
+    else:
+        app.run_polling()
 
 
 if __name__ == "__main__":
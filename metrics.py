@@ -0,0 +1,226 @@
+import functools
+import inspect
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from telegram.ext import Application, BaseHandler, BaseRateLimiter, ConversationHandler
+
+from callbacks import CallbackRouter
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a dictionary lookup to a stuck Bot API call.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'errors')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.errors = 0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, seconds: float, error: bool):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.errors += error
+
+
+class Registry:
+    """
+    Call counts, error counts and latency histograms by metric and labels.
+
+    Observations come both from the event loop and from the storage
+    thread, so they are recorded under a lock.
+    """
+
+    def __init__(self):
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._help: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def observe(self, name: str, labels: Labels, seconds: float, error: bool = False):
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            histogram = histograms.get(labels)
+            if histogram is None:
+                histogram = histograms[labels] = Histogram()
+            histogram.observe(seconds, error)
+
+    def render(self) -> str:
+        """Formats all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, histograms in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines.append(f'# HELP {name}_seconds {self._help[name]}')
+                lines.append(f'# TYPE {name}_seconds histogram')
+                for labels, histogram in sorted(histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_seconds_bucket{_labels(labels, le=bound)} {cumulative}')
+                    lines.append(f'{name}_seconds_sum{_labels(labels)} {histogram.sum:.6f}')
+                    lines.append(f'{name}_seconds_count{_labels(labels)} {cumulative}')
+                lines.append(f'# TYPE {name}_errors_total counter')
+                for labels, histogram in sorted(histograms.items()):
+                    lines.append(f'{name}_errors_total{_labels(labels)} {histogram.errors}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> List[str]:
+        """One line per metric and labels, for logging."""
+        with self._lock:
+            return [
+                f'{name}{_labels(labels)} calls={histogram.count} errors={histogram.errors} '
+                f'mean={histogram.sum / histogram.count * 1000:.2f}ms'
+                for name, histograms in sorted(self._histograms.items())
+                for labels, histogram in sorted(histograms.items())
+                if histogram.count
+            ]
+
+
+def _labels(labels: Labels, **extra) -> str:
+    pairs = list(labels) + [(key, str(value)) for key, value in extra.items()]
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+registry = Registry()
+registry.describe('handler', 'Time spent in update handler callbacks')
+registry.describe('repository', 'Time spent in order repository methods')
+registry.describe('bot_api', 'Time spent in Bot API requests, without rate limiting')
+registry.describe('bot_api_total', 'Time spent in Bot API requests, including rate limiting and retries')
+
+
+def timed_async(name: str, labels: Labels, func: Callable) -> Callable:
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        error = True
+        try:
+            result = await func(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            registry.observe(name, labels, time.perf_counter() - start, error)
+    return wrapper
+
+
+def timed(name: str, labels: Labels, func: Callable) -> Callable:
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        error = True
+        try:
+            result = func(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            registry.observe(name, labels, time.perf_counter() - start, error)
+    return wrapper
+
+
+def instrument_application(application: Application):
+    """
+    Times the callback of every handler registered with ``application``,
+    including the ones its conversations dispatch to. Call it once all
+    handlers are added.
+    """
+    wrapped = {}
+
+    def wrap(callback: Callable) -> Callable:
+        if callback not in wrapped:
+            wrapped[callback] = timed_async(
+                'handler', (('callback', callback.__name__),), callback
+            )
+        return wrapped[callback]
+
+    def instrument(handlers: Iterable[BaseHandler]):
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                instrument(handler.entry_points)
+                instrument(handler.fallbacks)
+                for state_handlers in handler.states.values():
+                    instrument(state_handlers)
+            elif isinstance(handler, CallbackRouter):
+                handler.routes = {code: wrap(callback) for code, callback in handler.routes.items()}
+            else:
+                handler.callback = wrap(handler.callback)
+
+    for handlers in application.handlers.values():
+        instrument(handlers)
+
+
+def instrument_repository(repository):
+    """Times every public method of an ``OrderRepository``."""
+    backend = type(repository).__name__
+    for name, method in inspect.getmembers(repository, inspect.ismethod):
+        if not name.startswith('_'):
+            setattr(repository, name, timed('repository', (('backend', backend), ('method', name)), method))
+
+
+def instrument_rate_limiter(limiter: BaseRateLimiter):
+    """Times Bot API requests going through ``limiter``."""
+    process_request = limiter.process_request
+
+    @functools.wraps(process_request)
+    async def wrapper(callback, args, kwargs, endpoint, data, rate_limit_args):
+        labels = (('endpoint', endpoint),)
+        return await timed_async('bot_api_total', labels, process_request)(
+            timed_async('bot_api', labels, callback), args, kwargs, endpoint, data, rate_limit_args,
+        )
+
+    limiter.process_request = wrapper
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(host: str, port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info('Serving metrics on http://%s:%s/metrics', host, port)
+    return server
+
+
+def log_periodically(interval: float) -> threading.Event:
+    # Enabled explicitly, so the summaries show up without --verbose.
+    logger.setLevel(logging.INFO)
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            for line in registry.summary():
+                logger.info(line)
+
+    threading.Thread(target=run, name='metrics-logger', daemon=True).start()
+    return stopped
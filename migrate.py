@@ -0,0 +1,111 @@
+import argparse
+import logging
+import os
+import sqlite3
+from typing import Iterable, Iterator, List
+
+from archive import ArchiveStore
+from model import Order
+from repositories import (
+    ARCHIVE_DIR, DB_BACKEND, DB_CODEC, DB_PATH, SQLITE_PATH, SQLiteOrderRepository, create_order_repository, open_codec,
+)
+from shards import SHARDS_DIR, chat_directory
+from storages import detect_file_codec, read_database
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_to_sqlite(source: str, target: str, archive_dir: str = ARCHIVE_DIR) -> int:
+    # The source files are only read.
+    orders = _read_tinydb(source)
+    repository = SQLiteOrderRepository(target, ArchiveStore(archive_dir))
+    try:
+        return repository.import_orders(_checked(orders))
+    finally:
+        repository.close()
+
+
+def split_into_shards(chats: Iterable[int], shards_dir: str = SHARDS_DIR, backend: str = DB_BACKEND) -> int:
+    """
+    Copies the orders kept before DB_SHARDS_DIR was set, live and archived,
+    into the shard of every one of ``chats`` and returns how many there were.
+
+    Orders don't record the chat they were made in, so every chat gets all
+    of them, as every operator saw them before. Orders a shard already has
+    are left as they are, so it can be run again. The old files are only read.
+    """
+    live = list(_checked(_read_tinydb(DB_PATH) if backend == 'tinydb' else _read_sqlite(SQLITE_PATH)))
+    archived = list(ArchiveStore(ARCHIVE_DIR).iter_orders()) if os.path.isdir(ARCHIVE_DIR) else []
+    for chat in chats:
+        repository = create_order_repository(backend, os.path.join(shards_dir, str(chat)))
+        try:
+            repository.add_many(order.model_copy(deep=True) for order in live if repository.get(order.id) is None)
+            repository.archive.append(order for order in archived if repository.get(order.id) is None)
+            repository.move_archived_orders()
+            repository.rebuild_stats()
+        finally:
+            repository.close()
+        logger.info('Copied the orders into the shard of chat %s', chat)
+    return len(live) + len(archived)
+
+
+def _read_tinydb(path: str) -> List[Order]:
+    # Read in whichever format it was written, together with any
+    # uncommitted db.json.wal records.
+    data, _ = read_database(path, open_codec(detect_file_codec(path) or DB_CODEC))
+    return [Order(**doc) for doc in data.get('orders', {}).values()]
+
+
+def _read_sqlite(path: str) -> List[Order]:
+    if not os.path.exists(path):
+        return []
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        return [SQLiteOrderRepository._from_row(row) for row in conn.execute('SELECT * FROM orders')]
+    finally:
+        conn.close()
+
+
+def _checked(orders: Iterable[Order]) -> Iterator[Order]:
+    for order in orders:
+        if order.unparsed_amounts:
+            logger.warning('Order %032x has amounts that are not numbers, copied as text: %s',
+                           order.id, order.unparsed_amounts)
+        yield order
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Copy orders from a TinyDB file into SQLite')
+    parser.add_argument('source', nargs='?')
+    parser.add_argument('target', nargs='?')
+    parser.add_argument('--chat', type=int, help='Chat whose orders to migrate when they are sharded by chat')
+    parser.add_argument(
+        '--split-into-shards', type=int, nargs='+', metavar='CHAT',
+        help='Copy the orders kept before DB_SHARDS_DIR was set into the shards of these chats. '
+             'Each chat only sees the orders in its own shard, so list every operator chat '
+             'that should keep seeing the old ones',
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.split_into_shards:
+        if SHARDS_DIR is None:
+            parser.error('--split-into-shards needs DB_SHARDS_DIR to be set')
+        count = split_into_shards(args.split_into_shards)
+        logger.info('Copied %s orders into the shards of %s chats', count, len(args.split_into_shards))
+        return
+
+    # A chat's files go by the same names in its shard directory.
+    directory = chat_directory(parser, args.chat)
+    source, target, archive_dir = (
+        path if directory is None else os.path.join(directory, os.path.basename(path))
+        for path in (DB_PATH, SQLITE_PATH, ARCHIVE_DIR)
+    )
+    source, target = args.source or source, args.target or target
+    count = migrate_to_sqlite(source, target, archive_dir)
+    logger.info('Migrated %s orders from %s to %s', count, source, target)
+
+
+if __name__ == '__main__':
+    main()
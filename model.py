@@ -1,10 +1,126 @@
-import uuid
+import random
+import re
 from datetime import datetime
 from enum import Enum
-from typing import List, Optional
+from collections import namedtuple
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from decimal import Decimal
-from pydantic import BaseModel, Field
+from decimal import Decimal, InvalidOperation
+from pydantic import BaseModel, Field, field_validator, model_validator
+
+MONEY_FIELDS = ('income', 'price', 'delivery_price', 'service_fee')
+# Spaces, including the narrow no-break one, and apostrophes group thousands.
+_MONEY_GROUPING = re.compile(r"[\s'’]")
+_MONEY = re.compile(r'[^\d.,-]*(-?\d[\d.,]*)\D*')
+
+
+class AmbiguousAmountError(ValueError):
+    pass
+
+
+def parse_money(text) -> Optional[Decimal]:
+    """
+    Parses an amount the way people type it, "1 250,50 грн", "₴1250.5" or
+    "1.250,50". A lone separator is the decimal one, a repeated one groups
+    thousands. A lone separator before exactly three digits, as in "1,000",
+    could be either, so it raises ``AmbiguousAmountError``. Raises
+    ``ValueError`` for anything else.
+    """
+    if text is None or isinstance(text, Decimal):
+        return text
+    if isinstance(text, (int, float)):
+        return Decimal(str(text))
+    match = _MONEY.fullmatch(_MONEY_GROUPING.sub('', text))
+    if match is None:
+        if not text.strip():
+            return None
+        raise ValueError(f'Not an amount: {text!r}')
+    number = match[1]
+    separators = [c for c in number if c in '.,']
+    decimal = separators[-1] if separators and separators.count(separators[-1]) == 1 else None
+    if decimal is not None and len(separators) == 1 and len(number.rpartition(decimal)[2]) == 3:
+        raise AmbiguousAmountError(f'Thousands or a fraction: {text!r}')
+    for separator in '.,':
+        if separator != decimal:
+            number = number.replace(separator, '')
+    try:
+        return Decimal(number.replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f'Not an amount: {text!r}') from None
+
+
+def read_money(value) -> Optional[Decimal]:
+    """
+    Reads a stored amount: the decimal text amounts are written as, exactly,
+    or what was typed before amounts were parsed, with ``parse_money``.
+    """
+    if isinstance(value, str):
+        try:
+            amount = Decimal(value)
+        except InvalidOperation:
+            pass
+        else:
+            if amount.is_finite():
+                return amount
+    return parse_money(value)
+
+
+def to_money(value) -> Optional[Decimal]:
+    """
+    Like ``read_money``, but stored text that is not an amount reads as
+    ``None``. Only for what is never written back: ``Order`` keeps such text
+    in ``unparsed_amounts``, and so do projections of that field.
+    """
+    try:
+        return read_money(value)
+    except ValueError:
+        return None
+
+
+def unparsed_amounts(data: dict) -> Dict[str, str]:
+    """The amounts of a stored order that ``read_money`` rejects, as the text they were stored as."""
+    unparsed = dict(data.get('unparsed_amounts') or {})
+    for name in MONEY_FIELDS:
+        value = data.get(name)
+        if isinstance(value, str):
+            try:
+                read_money(value)
+            except ValueError:
+                unparsed[name] = value
+    return unparsed
+
+
+_RANDOM_BITS = 74
+_last_order_id = 0
+
+
+def order_id(created_at: datetime, random_bits: int) -> int:
+    """
+    A UUIDv7: the Unix time in milliseconds in the top 48 bits, then the
+    version, 74 random bits and the variant. Ids made later compare
+    greater, unlike the random UUIDv4 ids of older orders.
+    """
+    millis = int(created_at.timestamp() * 1000)
+    return (
+        millis << 80 | 0x7 << 76 | (random_bits >> 62) << 64 | 0b10 << 62
+        | random_bits & (1 << 62) - 1
+    )
+
+
+def new_order_id() -> int:
+    global _last_order_id
+    id_ = order_id(datetime.now(), random.getrandbits(_RANDOM_BITS))
+    # Within a millisecond, or if the clock steps back, ids still increase.
+    _last_order_id = id_ = max(id_, _last_order_id + 1)
+    return id_
+
+
+def order_id_time(id_: int) -> Optional[datetime]:
+    """When an order with a UUIDv7 id was created, ``None`` for older ids."""
+    if id_ >> 76 & 0xf != 0x7:
+        return None
+    return datetime.fromtimestamp((id_ >> 80) / 1000)
 
 
 class EditableModel(BaseModel):
@@ -41,27 +157,45 @@ class CustomerInfo(EditableModel):
 
 
 class Order(BaseModel):
-    id: int = Field(default_factory=lambda: uuid.uuid4().int, title='ID')
+    id: int = Field(default_factory=new_order_id, title='ID')
     created_at: Optional[datetime] = Field(default_factory=datetime.now, title="Дата створення")
     customer_info: CustomerInfo = Field(title='Інформація про клієнта', default_factory=CustomerInfo)
     shop_url: Optional[str] = Field(None, title='Посилання на магазин')
     products: List[str] = Field(default_factory=list, title='Товари')
-    income: Optional[str] = Field(None, title='Скинули')
-    price: Optional[str] = Field(None, title='Вартість всіх товарів')
+    income: Optional[Decimal] = Field(None, title='Скинули')
+    price: Optional[Decimal] = Field(None, title='Вартість всіх товарів')
     delivery_service: Optional[str] = Field(None, title='Служба доставки')
-    delivery_price: Optional[str] = Field(None, title="Вартість доставки")
-    service_fee: Optional[str] = Field(None, title="Комісія")
+    delivery_price: Optional[Decimal] = Field(None, title="Вартість доставки")
+    service_fee: Optional[Decimal] = Field(None, title="Комісія")
     received_at: Optional[datetime] = Field(None, title="Дата отримання")
     received_by_customer_at: Optional[datetime] = Field(None, title="Дата отримання клієнтом")
     status: Optional[OrderStatus] = Field(OrderStatus.NEW, title="Статус")
     products_tracking: List[bool] = Field(default_factory=list, title="Наявність ТТН")
     archived_at: Optional[datetime] = Field(None, title="Дата архівування")
+    # Amounts stored as free-form text before they were parsed, which
+    # ``read_money`` rejects, by field name. Kept until the field is set anew.
+    unparsed_amounts: Dict[str, str] = Field(default_factory=dict, title="Нерозпізнані суми")
+    version: int = Field(0, title="Версія")
+
+    @model_validator(mode='before')
+    @classmethod
+    def _keep_unparsed_amounts(cls, data):
+        # Orders written before amounts were parsed may hold free-form text.
+        if not isinstance(data, dict) or not any(isinstance(data.get(name), str) for name in MONEY_FIELDS):
+            return data
+        unparsed = unparsed_amounts(data)
+        return {**data, **dict.fromkeys(unparsed.keys() & set(MONEY_FIELDS)), 'unparsed_amounts': unparsed}
+
+    @field_validator(*MONEY_FIELDS, mode='before')
+    @classmethod
+    def _parse_money(cls, value):
+        return read_money(value)
 
 
 class InProgressOrder(EditableModel):
     id: int
-    delivery_price: Optional[str] = Field(None, title="Вартість доставки")
-    service_fee: Optional[str] = Field(None, title="Комісія")
+    delivery_price: Optional[Decimal] = Field(None, title="Вартість доставки")
+    service_fee: Optional[Decimal] = Field(None, title="Комісія")
     status: OrderStatus = Field(OrderStatus.IN_PROGRESS)
 
     @classmethod
@@ -73,8 +207,8 @@ class NewOrder(EditableModel):
     customer_info: CustomerInfo = Field(title='Інформація про клієнта', default_factory=CustomerInfo)
     shop_url: Optional[str] = Field(None, title='Посилання на магазин')
     products: List[str] = Field(default_factory=list, title='Товари')
-    income: Optional[str] = Field(None, title='Скинули')
-    price: Optional[str] = Field(None, title='Вартість всіх товарів')
+    income: Optional[Decimal] = Field(None, title='Скинули')
+    price: Optional[Decimal] = Field(None, title='Вартість всіх товарів')
     delivery_service: Optional[str] = Field(None, title='Служба доставки')
 
 
@@ -95,3 +229,54 @@ def get_fields_paths(model: EditableModel) -> list:
         else:
             paths.append(field)
     return paths
+
+
+def _to_datetime(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _to_status(value):
+    return OrderStatus(value)
+
+
+# Stored values that are not kept as their Python type by every backend.
+_PROJECTION_CONVERTERS: Dict[str, Callable[[Any], Any]] = {
+    name: _to_datetime for name, field in Order.model_fields.items() if field.annotation == Optional[datetime]
+}
+_PROJECTION_CONVERTERS['status'] = _to_status
+_PROJECTION_CONVERTERS.update(dict.fromkeys(MONEY_FIELDS, to_money))
+
+
+Projection = Tuple[str, ...]
+
+
+@lru_cache(maxsize=None)
+def _compile_projection(fields: Projection):
+    record = namedtuple('OrderProjection', [field.rpartition('.')[2] for field in fields])
+    getters = tuple(
+        # Read from the whole order, the money fields may hold the text.
+        (None, '', unparsed_amounts) if field == 'unparsed_amounts'
+        else (*field.partition('.')[::2], _PROJECTION_CONVERTERS.get(field))
+        for field in fields
+    )
+    return record, getters
+
+
+def project_order(data: dict, fields: Projection) -> tuple:
+    """
+    Picks ``fields`` of a stored order into a named tuple, without
+    building and validating the whole ``Order``. Nested fields are named
+    like ``customer_info.full_name`` and become attributes named after
+    their last part, ``full_name``.
+    """
+    record, getters = _compile_projection(fields)
+    values = []
+    for parent, name, converter in getters:
+        if parent is None:
+            values.append(converter(data))
+            continue
+        value = data.get(parent)
+        if name:
+            value = value.get(name) if value else None
+        values.append(converter(value) if converter is not None and value is not None else value)
+    return record._make(values)
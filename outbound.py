@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+JSONDict = Dict[str, Any]
+
+# Endpoints that post something into a chat and count towards flood limits.
+THROTTLED_PREFIXES = ('send', 'edit', 'copy', 'forward')
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Takes a token and returns how many seconds to wait before using it."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        return max(0.0, -self._tokens / self.rate)
+
+    def is_full(self) -> bool:
+        return self._tokens + (time.monotonic() - self._updated) * self.rate >= self.capacity
+
+
+class FloodControlRateLimiter(BaseRateLimiter[int]):
+    """
+    Outbound queue for Bot API requests.
+
+    Requests for different chats go out concurrently. Requests for the same
+    chat are sent one at a time in the order they were made, so replies
+    never overtake each other. Message-sending endpoints draw from a global
+    token bucket and one bucket per chat, following Telegram's limits of
+    about 30 messages per second overall, one per second in private chats
+    and 20 per minute in groups. ``RetryAfter`` responses pause all sends
+    and are retried with growing backoff, up to ``max_retries`` times
+    (or ``rate_limit_args`` when a call passes it).
+    """
+
+    def __init__(
+        self,
+        overall_rate: float = 30,
+        private_rate: float = 1,
+        group_rate: float = 20 / 60,
+        burst: int = 3,
+        max_retries: int = 3,
+    ):
+        self._overall = TokenBucket(overall_rate, overall_rate)
+        self._private_rate = private_rate
+        self._group_rate = group_rate
+        self._burst = burst
+        self._max_retries = max_retries
+        self._buckets: Dict[Union[int, str], TokenBucket] = {}
+        self._locks: Dict[Union[int, str], asyncio.Lock] = {}
+        self._queued: Dict[Union[int, str], int] = {}
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, JSONDict, List[JSONDict]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, JSONDict, List[JSONDict]]:
+        max_retries = self._max_retries if rate_limit_args is None else rate_limit_args
+        chat_id = data.get('chat_id')
+        throttled = endpoint.startswith(THROTTLED_PREFIXES)
+
+        if chat_id is None:
+            return await self._send(callback, args, kwargs, max_retries, None, throttled)
+
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        self._queued[chat_id] = self._queued.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                return await self._send(callback, args, kwargs, max_retries, chat_id, throttled)
+        finally:
+            self._queued[chat_id] -= 1
+            if not self._queued[chat_id]:
+                del self._queued[chat_id]
+                del self._locks[chat_id]
+
+    async def _send(self, callback, args, kwargs, max_retries: int, chat_id, throttled: bool):
+        for attempt in range(max_retries + 1):
+            await self._resumed.wait()
+            if throttled:
+                await self._acquire(chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                if attempt == max_retries:
+                    raise
+                delay = exc.retry_after + 0.5 * attempt
+                logger.info('Flood limit hit, retrying in %.1f seconds', delay)
+                self._resumed.clear()
+                try:
+                    await asyncio.sleep(delay)
+                finally:
+                    self._resumed.set()
+
+    async def _acquire(self, chat_id):
+        delay = self._overall.reserve()
+        if chat_id is not None:
+            bucket = self._buckets.get(chat_id)
+            if bucket is None:
+                if len(self._buckets) >= 1024:
+                    # A full bucket behaves exactly like a fresh one, so idle chats can go.
+                    self._buckets = {key: b for key, b in self._buckets.items() if not b.is_full()}
+                rate = self._group_rate if self._is_group(chat_id) else self._private_rate
+                bucket = self._buckets[chat_id] = TokenBucket(rate, self._burst)
+            delay = max(delay, bucket.reserve())
+        if delay:
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _is_group(chat_id) -> bool:
+        try:
+            return int(chat_id) < 0
+        except (TypeError, ValueError):
+            return True
+
+
+class PassThroughRateLimiter(BaseRateLimiter[Any]):
+    """Sends every Bot API request right away, for hooking into the requests without limiting them."""
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, JSONDict, List[JSONDict]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Any],
+    ) -> Union[bool, JSONDict, List[JSONDict]]:
+        return await callback(*args, **kwargs)
@@ -0,0 +1,145 @@
+import inspect
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Type, get_origin
+
+from pydantic import BaseModel
+from telegram import Message
+from telegram.helpers import escape_markdown
+
+FieldFormatter = Callable[[BaseModel, Any], Optional[str]]
+
+
+def _format_scalar(model: BaseModel, value) -> str:
+    return escape_markdown(str(value), version=2)
+
+
+def _format_nested(model: BaseModel, value) -> str:
+    if not isinstance(value, BaseModel):
+        return _format_scalar(model, value)
+    return ('\n\t\t' + '\t\t'.join(format_model(value).splitlines(True))).rstrip('\n')
+
+
+def _format_list(model: BaseModel, value) -> str:
+    if not isinstance(value, list):
+        return _format_scalar(model, value)
+    return '\n\t\t' + escape_markdown('\n\t\t'.join(value))
+
+
+def _format_mapping(model: BaseModel, value) -> Optional[str]:
+    """Entries keyed by field names of ``model``, under their titles. Left out when empty."""
+    if not value:
+        return None
+    return '\n\t\t' + '\n\t\t'.join(
+        f'{escape_markdown(model.model_fields[name].title, version=2)}: {_format_scalar(model, text)}'
+        for name, text in value.items()
+    )
+
+
+def _format_products(model: BaseModel, value) -> str:
+    tracking = getattr(model, 'products_tracking')
+    products = [
+        (
+            escape_markdown(p) + '\t\t\t(є ТТН)'
+            if next(iter(tracking[i:i+1]), None)
+            else escape_markdown(p)
+        )
+        for i, p in enumerate(value)
+    ]
+    return _format_scalar(model, '\n\t\t' + '\n\t\t'.join(products))
+
+
+_FORMATTERS: Dict[Type[BaseModel], List[Tuple[str, str, FieldFormatter]]] = {}
+
+
+def get_formatters(model: Type[BaseModel]) -> List[Tuple[str, str, FieldFormatter]]:
+    if model not in _FORMATTERS:
+        formatters = []
+        for field_name, field in model.model_fields.items():
+            annotation = field.annotation
+            if field_name in ('products_tracking', 'version'):
+                continue
+            elif field_name == 'products':
+                formatter = _format_products
+            elif inspect.isclass(annotation) and issubclass(annotation, BaseModel):
+                formatter = _format_nested
+            elif get_origin(annotation) is list:
+                formatter = _format_list
+            elif get_origin(annotation) is dict:
+                formatter = _format_mapping
+            else:
+                formatter = _format_scalar
+            formatters.append((field_name, f'*{field.title}*: ', formatter))
+        _FORMATTERS[model] = formatters
+    return _FORMATTERS[model]
+
+
+def format_model(model: BaseModel) -> str:
+    values = (
+        (label, formatter(model, getattr(model, field_name)))
+        for field_name, label, formatter in get_formatters(type(model))
+    )
+    return ''.join(f'{label}{text}\n' for label, text in values if text is not None)
+
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default=None):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def put(self, key: Hashable, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+def fingerprint(value) -> Hashable:
+    if isinstance(value, BaseModel):
+        return tuple(fingerprint(getattr(value, name)) for name in type(value).model_fields)
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+# Rendered text per model id, valid while the model's fields stay the same.
+rendered = LRUCache(2048)
+# What was last put into every message the bot sent or edited.
+displayed = LRUCache(2048)
+
+
+def render(model: BaseModel) -> str:
+    key = getattr(model, 'id', None)
+    if key is None:
+        return format_model(model)
+
+    version = fingerprint(model)
+    cached = rendered.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    text = format_model(model)
+    rendered.put(key, (version, text))
+    return text
+
+
+async def send(message: Message, text: str, method='reply_text', **kwargs) -> Optional[Message]:
+    """Sends or edits a message, skipping edits that would not change it."""
+    content = (text, kwargs.get('reply_markup'))
+    if method == 'edit_text':
+        if displayed.get((message.chat_id, message.message_id)) == content:
+            return None
+
+    result = await getattr(message, method)(text, **kwargs)
+    if isinstance(result, Message):
+        displayed.put((result.chat_id, result.message_id), content)
+    return result
+
+
+async def display_data(message: Message, model: BaseModel, method='reply_text', **kwargs) -> None:
+    await send(message, render(model), method, parse_mode='MarkdownV2', **kwargs)
@@ -1,42 +1,1069 @@
-from typing import List, Optional
+import asyncio
+import heapq
+import json
+import logging
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain, islice
+from bisect import bisect_left, insort
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
 
-from tinydb import TinyDB, Query, JSONStorage
-from tinydb_serialization import SerializationMiddleware
+from tinydb import TinyDB
+from tinydb.table import Table
 from tinydb_serialization.serializers import DateTimeSerializer
 
-from model import Order, OrderStatus
+import env
+from archive import ArchiveStore
+from model import MONEY_FIELDS, Order, OrderStatus, Projection, project_order
+from search import SearchIndex
+from stats import STATS_FIELDS, STATUS, OrderStats, StatsKey, Totals
+from storages import CODECS, Codec, CodecStorage, DecimalSerializer, LoggedTable, WriteAheadLogStorage
 
+DB_BACKEND = env.get('DB_BACKEND', default='tinydb')
+DB_PATH = env.get('DB_PATH', default='db.json')
+DB_STORAGE = env.get('DB_STORAGE', default='json')
+DB_CODEC = env.get('DB_CODEC', default='json')
+SQLITE_PATH = env.get('SQLITE_PATH', default='orders.sqlite3')
+ARCHIVE_DIR = env.get('ARCHIVE_DIR', default='archive')
 
-serialization = SerializationMiddleware(JSONStorage)
-serialization.register_serializer(DateTimeSerializer(), 'TinyDate')
-db = TinyDB('db.json', storage=serialization)
+logger = logging.getLogger(__name__)
 
 
-class OrderRepository:
-    _table = db.table('orders')
+def open_codec(name: str = DB_CODEC) -> Codec:
+    if name not in CODECS:
+        raise ValueError(f'Unknown DB_CODEC: {name}')
+    codec = CODECS[name]()
+    codec.register_serializer(DateTimeSerializer(), 'TinyDate')
+    codec.register_serializer(DecimalSerializer(), 'Decimal')
+    return codec
+
+
+def open_db(path: str = DB_PATH, storage: str = DB_STORAGE, codec: str = DB_CODEC) -> TinyDB:
+    codec = open_codec(codec)
+    if storage == 'wal':
+        db = TinyDB(
+            path,
+            storage=WriteAheadLogStorage,
+            codec=codec,
+            commit_interval=env.get('DB_COMMIT_INTERVAL', float, 0.5),
+        )
+        db.table_class = LoggedTable
+        return db
+    if storage == 'json':
+        return TinyDB(path, storage=CodecStorage, codec=codec)
+    raise ValueError(f'Unknown DB_STORAGE: {storage}')
+
+
+# Where a page of orders ended: the created_at and id of its last order.
+Cursor = Tuple[datetime, int]
+
+
+def cursor_of(record) -> Cursor:
+    return record.created_at, record.id
+
+
+class ConcurrentModificationError(RuntimeError):
+    def __init__(self, id_: int, expected: int, actual: int):
+        super().__init__(f'Order {id_} is at version {actual}, not {expected}')
+        self.id = id_
+        self.expected = expected
+        self.actual = actual
+
+
+class OrderRepository(ABC):
+    """
+    Live orders in a backend table, archived ones in an ``ArchiveStore``.
+
+    Archiving moves an order out of the table into the archive segments and
+    restoring moves it back, so the table only ever holds live orders.
+
+    ``add`` is a compare-and-swap on ``Order.version``: it stores the order
+    only if the stored copy still has the version the order was read at,
+    and bumps the version. ``update`` retries a read-modify-write on
+    conflicts.
+
+    The search index covers live and archived orders. It is built on the
+    first search and then kept up to date by ``add`` and ``remove``.
+
+    Order totals, see ``OrderStats``, are stored next to the orders and
+    changed by every write. ``rebuild_stats`` recounts them from scratch.
+    """
+
+    def __init__(self, archive: ArchiveStore):
+        self.archive = archive
+        self._search: Optional[SearchIndex] = None
+        self._stats: Optional[OrderStats] = None
 
     def add(self, order: Order) -> int:
-        return self._table.upsert(order.model_dump(), Query().id == order.id)[0]
+        """Raises ``ConcurrentModificationError`` if the order changed since it was read."""
+        before = self._project(order.id, STATS_FIELDS)
+        result = self._add(order)
+        self._count(before, order)
+        if self._search is not None:
+            self._index_for_search(project_order(order.model_dump(), SEARCH_FIELDS))
+        return result
 
-    def get(self, id_: int) -> Optional[Order]:
-        data = self._table.get(Query().id == id_)
-        if data:
-            return Order(**data)
+    def add_many(self, orders: Iterable[Order]) -> List[int]:
+        """
+        Stores distinct orders with one write. Raises ``ConcurrentModificationError``
+        for the first order that changed since it was read, storing none of them.
+        """
+        orders = list(orders)
+        if not orders:
+            return []
+        before = self._project_many([order.id for order in orders], STATS_FIELDS)
+        self._add_many(orders)
+        self._count_many((before.get(order.id), order) for order in orders)
+        if self._search is not None:
+            for order in orders:
+                self._index_for_search(project_order(order.model_dump(), SEARCH_FIELDS))
+        return [order.id for order in orders]
+
+    def update(self, id_: int, change: Callable[[Order], None], retries: int = 3) -> Optional[Order]:
+        for attempt in range(retries + 1):
+            order = self._get(id_)
+            if order is None:
+                return None
+            change(order)
+            try:
+                self.add(order)
+                return order
+            except ConcurrentModificationError:
+                if attempt == retries:
+                    raise
         return None
 
-    def get_by_status(self, status: OrderStatus) -> List[Order]:
-        data = self._table.search(
-            (Query().status == status) &
-            ((Query().archived_at == None) | ~(Query().archived_at.exists()))
-        )
-        if data:
-            return list(map(lambda d: Order(**d), data))
+    def update_many(self, ids: Iterable[int], change: Callable[[Order], None], retries: int = 3) -> List[Order]:
+        """``update`` for many orders at once, stored with one ``add_many``. Missing ids are skipped."""
+        ids = list(ids)
+        for attempt in range(retries + 1):
+            orders = self._get_many(ids)
+            for order in orders:
+                change(order)
+            try:
+                self.add_many(orders)
+                return orders
+            except ConcurrentModificationError:
+                if attempt == retries:
+                    raise
+        return []
+
+    def update_status_many(self, ids: Iterable[int], status: OrderStatus) -> List[Order]:
+        """Moves the orders to ``status``. Orders marked done are recorded as received by the customer now."""
+        now = datetime.now()
+
+        def move(order: Order):
+            order.status = status
+            if status == OrderStatus.DONE and order.received_by_customer_at is None:
+                order.received_at = order.received_at or now
+                order.received_by_customer_at = now
+
+        return self.update_many(ids, move)
+
+    def get(self, id_: int) -> Optional[Order]:
+        order = self._get(id_)
+        if order is None:
+            return self.archive.get(id_)
+        return order
+
+    def remove(self, id_: int) -> bool:
+        before = self._project(id_, STATS_FIELDS)
+        removed = self._remove(id_)
+        if removed:
+            self._count(before, None)
+        if self._search is not None:
+            self._search.remove(id_)
+        return removed
+
+    def search(
+        self, query: str, limit: Optional[int] = None, offset: int = 0,
+        fields: Optional[Projection] = None,
+    ) -> Tuple[int, list]:
+        """Returns the number of matches and a page of them, newest first."""
+        if self._search is None:
+            self._search = SearchIndex()
+            for record in self._iter_all(SEARCH_FIELDS):
+                self._index_for_search(record)
+            for record in self.archive.iter_orders(fields=SEARCH_FIELDS):
+                self._index_for_search(record)
+
+        # Only the page of ids is read, the live orders with one storage read.
+        total, ids = self._search.search(query, limit, offset)
+        if fields is None:
+            live = {order.id: order for order in self._get_many(ids)}
         else:
+            live = self._project_many(ids, fields)
+        page = []
+        for id_ in ids:
+            record = live.get(id_)
+            if record is None:
+                order = self.archive.get(id_)
+                record = order if order is None or fields is None else project_order(order.model_dump(), fields)
+            if record is not None:
+                page.append(record)
+        return total, page
+
+    @abstractmethod
+    def get_by_status(
+        self, status: OrderStatus, limit: Optional[int] = None, offset: int = 0,
+        fields: Optional[Projection] = None,
+    ) -> list:
+        """Returns orders, or records with just ``fields`` of them if given, see ``project_order``."""
+
+    @abstractmethod
+    def get_received_before(
+        self, received_before: datetime, limit: Optional[int] = None, fields: Optional[Projection] = None,
+    ) -> list:
+        """Live done orders the customer received before ``received_before``, the oldest created first."""
+
+    @abstractmethod
+    def get_range(
+        self, start: Optional[datetime] = None, end: Optional[datetime] = None, limit: Optional[int] = None,
+        after: Optional[Cursor] = None, newest_first: bool = False, fields: Optional[Projection] = None,
+    ) -> list:
+        """
+        Live orders created from ``start`` up to but excluding ``end``,
+        ordered by ``created_at`` and then id, which for new ids is their
+        creation order. A page continues ``after`` the cursor of the
+        previous one, so it costs the same however deep it is.
+        """
+
+    def iter_range(
+        self, start: Optional[datetime] = None, end: Optional[datetime] = None, newest_first: bool = False,
+        fields: Optional[Projection] = None, batch_size: int = 1000,
+    ) -> Iterator:
+        """All of ``get_range``, read ``batch_size`` orders at a time. ``fields`` must include id and created_at."""
+        after = None
+        while True:
+            page = self.get_range(start, end, batch_size, after, newest_first, fields)
+            yield from page
+            if len(page) < batch_size:
+                return
+            after = cursor_of(page[-1])
+
+    def get_archived(self, limit: Optional[int] = None, offset: int = 0, fields: Optional[Projection] = None) -> list:
+        return list(islice(self.archive.iter_orders(offset, fields), limit))
+
+    @abstractmethod
+    def count_by_status(self, status: OrderStatus) -> int:
+        ...
+
+    def count_archived(self) -> int:
+        return len(self.archive)
+
+    def archive_order(self, id_: int) -> Optional[Order]:
+        order = self._get(id_)
+        if order is None:
+            return None
+        live = order.model_copy()
+        order.archived_at = datetime.now()
+        # Written to the archive first, so a crash in between leaves a copy
+        # in the table rather than losing the order.
+        self.archive.append([order])
+        self._remove(id_)
+        self._count(live, order)
+        if self._search is not None:
+            self._index_for_search(project_order(order.model_dump(), SEARCH_FIELDS))
+        return order
+
+    def archive_many(self, ids: Iterable[int]) -> List[Order]:
+        """
+        Archives the orders with one archive append, one table write and
+        one totals write for all of them. Returns the archived orders.
+        """
+        orders = self._get_many(ids)
+        if not orders:
             return []
+        now = datetime.now()
+        changes = []
+        for order in orders:
+            changes.append((order.model_copy(), order))
+            order.archived_at = now
+        self.archive.append(orders)
+        self._remove_many([order.id for order in orders])
+        self._count_many(changes)
+        if self._search is not None:
+            for order in orders:
+                self._index_for_search(project_order(order.model_dump(), SEARCH_FIELDS))
+        return orders
+
+    def restore_order(self, id_: int) -> Optional[Order]:
+        if id_ not in self.archive:
+            return None
+        order = self.archive.get(id_)
+        archived = order.model_copy()
+        order.archived_at = None
+        self.add(order)
+        self.archive.remove([id_])
+        self._count(archived, None)
+        return order
+
+    def restore_many(self, ids: Iterable[int]) -> List[Order]:
+        """Restores the archived orders among ``ids`` with one table write and one archive append."""
+        orders = [order for order in map(self.archive.get, ids) if order is not None]
+        if not orders:
+            return []
+        archived = [order.model_copy() for order in orders]
+        for order in orders:
+            order.archived_at = None
+        self.add_many(orders)
+        self.archive.remove([order.id for order in orders])
+        self._count_many((before, None) for before in archived)
+        return orders
+
+    def move_archived_orders(self) -> int:
+        """Moves orders archived before archive segments existed out of the table."""
+        orders = self._get_archived_in_table()
+        self.archive.append(orders)
+        for order in orders:
+            self._remove(order.id)
+        return len(orders)
+
+    def get_stats(self, kind: str, start: Optional[str] = None, end: Optional[str] = None) -> List[Tuple[str, Totals]]:
+        """
+        Totals per day (``YYYY-MM-DD``), month (``YYYY-MM``) or status, with
+        keys from ``start`` to ``end`` inclusive, see ``OrderStats.items``.
+        """
+        return self._order_stats().items(kind, start, end)
+
+    def rebuild_stats(self) -> int:
+        """
+        Recounts the totals from all live and archived orders, returns how
+        many were counted. Lists the orders with amounts left out as text.
+        """
+        stats = OrderStats()
+        count = 0
+        unparsed = []
+        fields = ('id', *STATS_FIELDS, 'unparsed_amounts')
+        for record in chain(self._iter_all(fields), self.archive.iter_orders(fields=fields)):
+            stats.apply(None, record)
+            count += 1
+            if record.unparsed_amounts:
+                unparsed.append(record)
+        for record in unparsed:
+            logger.warning('Order %032x has amounts that are not numbers, left out of the totals: %s',
+                           record.id, record.unparsed_amounts)
+        self._save_stats(stats.totals(), replace=True)
+        self._stats = stats
+        return count
+
+    def close(self):
+        pass
+
+    def _order_stats(self) -> OrderStats:
+        if self._stats is None:
+            self._stats = OrderStats(self._load_stats())
+        return self._stats
+
+    def _count(self, before, after):
+        self._count_many([(before, after)])
+
+    def _count_many(self, changes: Iterable[tuple]):
+        stats = self._order_stats()
+        changed = {}
+        for before, after in changes:
+            changed.update(stats.apply(before, after))
+        if changed:
+            self._save_stats(changed)
+
+    def _index_for_search(self, record):
+        self._search.add(
+            record.id, record.created_at,
+            [record.full_name, record.shipping_address, record.shop_url, *record.products],
+            [record.phone_number],
+        )
+
+    @abstractmethod
+    def _add(self, order: Order) -> int:
+        ...
+
+    @abstractmethod
+    def _add_many(self, orders: List[Order]):
+        """All of ``_add`` or none of it for every order, with one write."""
+
+    @abstractmethod
+    def _remove(self, id_: int) -> bool:
+        ...
+
+    @abstractmethod
+    def _remove_many(self, ids: List[int]):
+        ...
+
+    @abstractmethod
+    def _iter_all(self, fields: Projection) -> Iterator[tuple]:
+        ...
+
+    @abstractmethod
+    def _get(self, id_: int) -> Optional[Order]:
+        ...
+
+    def _get_many(self, ids: Iterable[int]) -> List[Order]:
+        return [order for order in map(self._get, ids) if order is not None]
+
+    @abstractmethod
+    def _get_archived_in_table(self) -> List[Order]:
+        ...
+
+    @abstractmethod
+    def _project(self, id_: int, fields: Projection) -> Optional[tuple]:
+        ...
+
+    def _project_many(self, ids: List[int], fields: Projection) -> Dict[int, tuple]:
+        """Projections of the stored orders among ``ids``, by id."""
+        return {id_: record for id_, record in zip(ids, (self._project(id_, fields) for id_ in ids)) if record}
+
+    @abstractmethod
+    def _load_stats(self) -> Dict[StatsKey, Totals]:
+        ...
+
+    @abstractmethod
+    def _save_stats(self, changed: Dict[StatsKey, Totals], replace: bool = False):
+        """Stores ``changed`` totals, or only them if ``replace`` is set."""
+
+
+SEARCH_FIELDS = (
+    'id', 'created_at', 'customer_info.full_name', 'customer_info.phone_number',
+    'customer_info.shipping_address', 'products', 'shop_url',
+)
+
+T = TypeVar('T')
+
+
+class AsyncOrderRepository:
+    """
+    Awaitable facade over an ``OrderRepository``.
+
+    Every call runs on a dedicated single-thread executor, which also keeps
+    the underlying storage single-threaded. At most ``max_pending`` calls
+    are queued at a time; further callers wait for a free slot, so a slow
+    disk applies backpressure instead of piling up work.
+    """
+
+    def __init__(self, repository: OrderRepository, max_pending: int = 256):
+        self._repository = repository
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='orders')
+        self._slots = asyncio.Semaphore(max_pending)
+
+    @property
+    def repository(self) -> OrderRepository:
+        return self._repository
+
+    async def add(self, order: Order) -> int:
+        return await self._run(self._repository.add, order)
+
+    async def get(self, id_: int) -> Optional[Order]:
+        return await self._run(self._repository.get, id_)
+
+    async def update(self, id_: int, change: Callable[[Order], None], retries: int = 3) -> Optional[Order]:
+        return await self._run(self._repository.update, id_, change, retries)
+
+    async def add_many(self, orders: Iterable[Order]) -> List[int]:
+        return await self._run(self._repository.add_many, list(orders))
+
+    async def update_many(self, ids: Iterable[int], change: Callable[[Order], None], retries: int = 3) -> List[Order]:
+        return await self._run(self._repository.update_many, list(ids), change, retries)
+
+    async def update_status_many(self, ids: Iterable[int], status: OrderStatus) -> List[Order]:
+        return await self._run(self._repository.update_status_many, list(ids), status)
+
+    async def get_by_status(
+        self, status: OrderStatus, limit: Optional[int] = None, offset: int = 0,
+        fields: Optional[Projection] = None,
+    ) -> list:
+        return await self._run(self._repository.get_by_status, status, limit, offset, fields)
+
+    async def get_range(
+        self, start: Optional[datetime] = None, end: Optional[datetime] = None, limit: Optional[int] = None,
+        after: Optional[Cursor] = None, newest_first: bool = False, fields: Optional[Projection] = None,
+    ) -> list:
+        return await self._run(self._repository.get_range, start, end, limit, after, newest_first, fields)
+
+    async def remove(self, id_: int) -> bool:
+        return await self._run(self._repository.remove, id_)
+
+    async def search(
+        self, query: str, limit: Optional[int] = None, offset: int = 0,
+        fields: Optional[Projection] = None,
+    ) -> Tuple[int, list]:
+        return await self._run(self._repository.search, query, limit, offset, fields)
+
+    async def get_archived(self, limit: Optional[int] = None, offset: int = 0, fields: Optional[Projection] = None) -> list:
+        return await self._run(self._repository.get_archived, limit, offset, fields)
+
+    async def count_by_status(self, status: OrderStatus) -> int:
+        return await self._run(self._repository.count_by_status, status)
+
+    async def count_archived(self) -> int:
+        return await self._run(self._repository.count_archived)
 
-    def get_archived(self) -> List[Order]:
-        data = self._table.search(Query().archived_at != None)
-        if data:
-            return list(map(lambda d: Order(**d), data))
+    async def get_stats(self, kind: str, start: Optional[str] = None, end: Optional[str] = None) -> List[Tuple[str, Totals]]:
+        return await self._run(self._repository.get_stats, kind, start, end)
+
+    async def archive_order(self, id_: int) -> Optional[Order]:
+        return await self._run(self._repository.archive_order, id_)
+
+    async def archive_many(self, ids: Iterable[int]) -> List[Order]:
+        return await self._run(self._repository.archive_many, list(ids))
+
+    async def get_received_before(
+        self, received_before: datetime, limit: Optional[int] = None, fields: Optional[Projection] = None,
+    ) -> list:
+        return await self._run(self._repository.get_received_before, received_before, limit, fields)
+
+    async def restore_order(self, id_: int) -> Optional[Order]:
+        return await self._run(self._repository.restore_order, id_)
+
+    async def restore_many(self, ids: Iterable[int]) -> List[Order]:
+        return await self._run(self._repository.restore_many, list(ids))
+
+    async def stream(self, func: Callable[..., Iterator[T]], *args, **kwargs) -> AsyncIterator[T]:
+        """
+        Iterates over ``func(repository, *args, **kwargs)``, computing each
+        item on the executor, so other calls get in between items.
+        """
+        items = func(self._repository, *args, **kwargs)
+        done = object()
+        while True:
+            item = await self._run(next, items, done)
+            if item is done:
+                return
+            yield item
+
+    async def close(self):
+        await self._run(self._repository.close)
+        self._executor.shutdown()
+
+    async def _run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, partial(func, *args, **kwargs)
+            )
+
+
+def create_order_repository(backend: str = DB_BACKEND, directory: Optional[str] = None) -> OrderRepository:
+    """
+    Opens the configured files, or ones of the same names in ``directory``,
+    which is created if needed. Each shard of ``ShardRouter`` has one.
+    """
+    db_path, sqlite_path, archive_dir = DB_PATH, SQLITE_PATH, ARCHIVE_DIR
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        db_path, sqlite_path, archive_dir = (
+            os.path.join(directory, os.path.basename(path)) for path in (DB_PATH, SQLITE_PATH, ARCHIVE_DIR)
+        )
+    archive = ArchiveStore(archive_dir)
+    if backend == 'tinydb':
+        repository = TinyDBOrderRepository(open_db(db_path).table('orders'), archive)
+    elif backend == 'sqlite':
+        repository = SQLiteOrderRepository(sqlite_path, archive)
+    else:
+        raise ValueError(f'Unknown DB_BACKEND: {backend}')
+    repository.move_archived_orders()
+    if not repository.get_stats(STATUS):
+        # Orders stored before totals were kept, or none at all yet.
+        repository.rebuild_stats()
+    return repository
+
+
+ARCHIVED = 'archived'
+
+IndexKey = Tuple[datetime, int]
+
+
+class TinyDBOrderRepository(OrderRepository):
+    """
+    Orders table with in-memory secondary indexes.
+
+    The indexes map order ids to TinyDB doc ids and keep one bucket per
+    status (plus one for archived orders) sorted by ``created_at``, so
+    lookups and listings only touch the documents they return. They are
+    rebuilt from the table on construction and kept up to date by ``add``.
+    Totals are documents of a ``stats`` table in the same database.
+    """
+
+    def __init__(self, table: Table, archive: ArchiveStore):
+        super().__init__(archive)
+        self._table = table
+        self._stats_table = type(table)(table.storage, 'stats')
+        self._stats_doc_ids: Dict[StatsKey, int] = {}
+        self._doc_ids: Dict[int, int] = {}
+        self._buckets: Dict[Any, List[IndexKey]] = defaultdict(list)
+        self._keys: Dict[int, Tuple[Any, IndexKey]] = {}
+        self._versions: Dict[int, int] = {}
+        for doc in self._table:
+            self._doc_ids[doc['id']] = doc.doc_id
+            self._versions[doc['id']] = doc.get('version', 0)
+            self._index(doc)
+
+    def _add(self, order: Order) -> int:
+        doc_id = self._doc_ids.get(order.id)
+        if doc_id is not None and self._versions[order.id] != order.version:
+            raise ConcurrentModificationError(order.id, order.version, self._versions[order.id])
+
+        data = order.model_dump()
+        data['version'] = order.version + 1
+        if doc_id is None:
+            doc_id = self._table.insert(data)
+            self._doc_ids[order.id] = doc_id
         else:
+            self._table.update(data, doc_ids=[doc_id])
+        self._versions[order.id] = order.version = data['version']
+        self._index(data)
+        return doc_id
+
+    def _add_many(self, orders: List[Order]):
+        for order in orders:
+            if order.id in self._doc_ids and self._versions[order.id] != order.version:
+                raise ConcurrentModificationError(order.id, order.version, self._versions[order.id])
+
+        docs = {}
+        for order in orders:
+            docs[order.id] = data = order.model_dump()
+            data['version'] = order.version + 1
+        # One write for the existing documents and one for the new ones.
+        existing = [self._doc_ids[id_] for id_ in docs if id_ in self._doc_ids]
+        if existing:
+            self._table.update(lambda doc: doc.update(docs[doc['id']]), doc_ids=existing)
+        new = [id_ for id_ in docs if id_ not in self._doc_ids]
+        if new:
+            self._doc_ids.update(zip(new, self._table.insert_multiple(docs[id_] for id_ in new)))
+        for order in orders:
+            self._versions[order.id] = order.version = docs[order.id]['version']
+            self._index(docs[order.id])
+
+    def _remove(self, id_: int) -> bool:
+        doc_id = self._doc_ids.pop(id_, None)
+        if doc_id is None:
+            return False
+        self._table.remove(doc_ids=[doc_id])
+        del self._versions[id_]
+        self._unindex(id_)
+        return True
+
+    def _remove_many(self, ids: List[int]):
+        doc_ids = [self._doc_ids.pop(id_) for id_ in ids if id_ in self._doc_ids]
+        if doc_ids:
+            self._table.remove(doc_ids=doc_ids)
+        for id_ in ids:
+            self._versions.pop(id_, None)
+            self._unindex(id_)
+
+    def get_received_before(
+        self, received_before: datetime, limit: Optional[int] = None, fields: Optional[Projection] = None,
+    ) -> list:
+        # No order is received before it was created, so only the part of
+        # the bucket created before the cutoff is read, oldest first and
+        # ``limit`` documents per storage read until ``limit`` match.
+        keys = self._buckets.get(OrderStatus.DONE, [])
+        end = bisect_left(keys, (received_before, -1))
+        ids = (id_ for _, id_ in islice(keys, end))
+        docs = []
+        while limit is None or len(docs) < limit:
+            batch = list(islice(ids, limit or end))
+            if not batch:
+                break
+            docs.extend(
+                doc for doc in self._docs(batch)
+                if doc.get('received_by_customer_at') is not None and doc['received_by_customer_at'] < received_before
+            )
+        docs = docs[:limit]
+        if fields is None:
+            return [Order(**doc) for doc in docs]
+        return [project_order(doc, fields) for doc in docs]
+
+    def get_by_status(
+        self, status: OrderStatus, limit: Optional[int] = None, offset: int = 0,
+        fields: Optional[Projection] = None,
+    ) -> list:
+        return self._load(self._page(self._buckets.get(status, []), limit, offset), fields)
+
+    def get_range(
+        self, start: Optional[datetime] = None, end: Optional[datetime] = None, limit: Optional[int] = None,
+        after: Optional[Cursor] = None, newest_first: bool = False, fields: Optional[Projection] = None,
+    ) -> list:
+        # Bounds as index keys, ids are never negative.
+        low = (start or datetime.min, -1)
+        high = (end, -1) if end is not None else (datetime.max, -1)
+        if after is not None and newest_first:
+            high = min(high, after)
+        elif after is not None:
+            low = max(low, (after[0], after[1] + 1))
+
+        # The live status buckets are sorted alike, so a merge of their slices is.
+        slices = []
+        for bucket, keys in self._buckets.items():
+            if bucket != ARCHIVED:
+                positions = range(bisect_left(keys, low), bisect_left(keys, high))
+                slices.append(map(keys.__getitem__, reversed(positions) if newest_first else positions))
+        return self._load(list(islice(heapq.merge(*slices, reverse=newest_first), limit)), fields)
+
+    def count_by_status(self, status: OrderStatus) -> int:
+        return len(self._buckets.get(status, []))
+
+    def close(self):
+        self._table.storage.close()
+
+    def _iter_all(self, fields: Projection) -> Iterator[tuple]:
+        return (project_order(doc, fields) for doc in self._table)
+
+    def _get(self, id_: int) -> Optional[Order]:
+        doc_id = self._doc_ids.get(id_)
+        if doc_id is None:
+            return None
+        return Order(**self._table.get(doc_id=doc_id))
+
+    def _get_many(self, ids: Iterable[int]) -> List[Order]:
+        return [Order(**doc) for doc in self._docs([id_ for id_ in ids if id_ in self._doc_ids])]
+
+    def _get_archived_in_table(self) -> List[Order]:
+        return self._load(self._buckets.get(ARCHIVED, []))
+
+    def _project(self, id_: int, fields: Projection) -> Optional[tuple]:
+        doc_id = self._doc_ids.get(id_)
+        if doc_id is None:
+            return None
+        return project_order(self._table.get(doc_id=doc_id), fields)
+
+    def _project_many(self, ids: List[int], fields: Projection) -> Dict[int, tuple]:
+        stored = [id_ for id_ in ids if id_ in self._doc_ids]
+        return {id_: project_order(doc, fields) for id_, doc in zip(stored, self._docs(stored))}
+
+    def _load_stats(self) -> Dict[StatsKey, Totals]:
+        totals = {}
+        for doc in self._stats_table:
+            key = (doc['kind'], doc['key'])
+            totals[key] = Totals(doc['orders'], *(Decimal(doc[name]) for name in MONEY_FIELDS))
+            self._stats_doc_ids[key] = doc.doc_id
+        return totals
+
+    def _save_stats(self, changed: Dict[StatsKey, Totals], replace: bool = False):
+        if replace:
+            self._stats_table.truncate()
+            self._stats_doc_ids.clear()
+        docs = {
+            key: {'kind': key[0], 'key': key[1], 'orders': totals.orders, **dict(zip(MONEY_FIELDS, totals.amounts))}
+            for key, totals in changed.items()
+        }
+        # One write for the existing documents and one for the new ones.
+        existing = [self._stats_doc_ids[key] for key in docs if key in self._stats_doc_ids]
+        if existing:
+            self._stats_table.update(lambda doc: doc.update(docs[doc['kind'], doc['key']]), doc_ids=existing)
+        new = [key for key in docs if key not in self._stats_doc_ids]
+        if new:
+            doc_ids = self._stats_table.insert_multiple(docs[key] for key in new)
+            self._stats_doc_ids.update(zip(new, doc_ids))
+
+    @staticmethod
+    def _page(keys: List[IndexKey], limit: Optional[int], offset: int) -> List[IndexKey]:
+        return keys[offset:None if limit is None else offset + limit]
+
+    def _docs(self, ids: List[int]) -> List[dict]:
+        # One storage read for all of them rather than one per document.
+        if not ids:
             return []
+        table = self._table.storage.read()[self._table.name]
+        return [table[str(self._doc_ids[id_])] for id_ in ids]
+
+    def _load(self, keys: List[IndexKey], fields: Optional[Projection] = None) -> list:
+        docs = self._docs([id_ for _, id_ in keys])
+        if fields is None:
+            return [Order(**doc) for doc in docs]
+        return [project_order(doc, fields) for doc in docs]
+
+    def _index(self, doc: dict):
+        id_ = doc['id']
+        if doc.get('archived_at'):
+            bucket = ARCHIVED
+        else:
+            bucket = doc.get('status') and OrderStatus(doc['status'])
+        key = (doc.get('created_at') or datetime.min, id_)
+
+        if self._keys.get(id_) == (bucket, key):
+            return
+        self._unindex(id_)
+        insort(self._buckets[bucket], key)
+        self._keys[id_] = (bucket, key)
+
+    def _unindex(self, id_: int):
+        previous = self._keys.pop(id_, None)
+        if previous is not None:
+            keys = self._buckets[previous[0]]
+            del keys[bisect_left(keys, previous[1])]
+
+
+ORDER_COLUMNS = (
+    'id', 'created_at', 'full_name', 'phone_number', 'shipping_address',
+    'shop_url', 'products', 'income', 'price', 'delivery_service',
+    'delivery_price', 'service_fee', 'received_at', 'received_by_customer_at',
+    'status', 'products_tracking', 'archived_at', 'unparsed_amounts', 'version',
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id TEXT PRIMARY KEY,
+    created_at TEXT,
+    full_name TEXT,
+    phone_number TEXT,
+    shipping_address TEXT,
+    shop_url TEXT,
+    products TEXT NOT NULL DEFAULT '[]',
+    income TEXT,
+    price TEXT,
+    delivery_service TEXT,
+    delivery_price TEXT,
+    service_fee TEXT,
+    received_at TEXT,
+    received_by_customer_at TEXT,
+    status TEXT,
+    products_tracking TEXT NOT NULL DEFAULT '[]',
+    archived_at TEXT,
+    unparsed_amounts TEXT,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS orders_status ON orders (status, archived_at, created_at);
+DROP INDEX IF EXISTS orders_archived_at;
+CREATE INDEX IF NOT EXISTS orders_live ON orders (archived_at, created_at, id);
+CREATE INDEX IF NOT EXISTS orders_created_at ON orders (created_at);
+CREATE TABLE IF NOT EXISTS order_stats (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    orders INTEGER NOT NULL,
+    income TEXT NOT NULL,
+    price TEXT NOT NULL,
+    delivery_price TEXT NOT NULL,
+    service_fee TEXT NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+"""
+
+
+def _format_datetime(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def _format_money(value) -> Optional[str]:
+    return str(value) if value is not None else None
+
+
+class SQLiteOrderRepository(OrderRepository):
+    """
+    Orders stored as columns of an SQLite table in WAL journal mode.
+
+    Ids are 128-bit, so they are kept as fixed-width hex text, which
+    sorts the same way as the integers. Datetimes are ISO 8601 text and
+    the product lists are JSON arrays. Amounts, and their totals in the
+    ``order_stats`` table, are decimal text.
+    """
+
+    def __init__(self, path: str, archive: ArchiveStore):
+        super().__init__(archive)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        columns = {row['name'] for row in self._conn.execute('PRAGMA table_info(orders)')}
+        if 'version' not in columns:
+            with self._conn:
+                self._conn.execute('ALTER TABLE orders ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+        if 'unparsed_amounts' not in columns:
+            with self._conn:
+                self._conn.execute('ALTER TABLE orders ADD COLUMN unparsed_amounts TEXT')
+
+    def _add(self, order: Order) -> int:
+        key = self._key(order.id)
+        with self._conn:
+            row = self._conn.execute('SELECT version FROM orders WHERE id = ?', (key,)).fetchone()
+            if row is not None and row['version'] != order.version:
+                raise ConcurrentModificationError(order.id, order.version, row['version'])
+            self._conn.execute(self._upsert_sql, self._to_row(order)[:-1] + (order.version + 1,))
+        order.version += 1
+        return order.id
+
+    def _add_many(self, orders: List[Order]):
+        with self._conn:
+            for order in orders:
+                row = self._conn.execute('SELECT version FROM orders WHERE id = ?', (self._key(order.id),)).fetchone()
+                if row is not None and row['version'] != order.version:
+                    raise ConcurrentModificationError(order.id, order.version, row['version'])
+            self._conn.executemany(
+                self._upsert_sql, [self._to_row(order)[:-1] + (order.version + 1,) for order in orders]
+            )
+        for order in orders:
+            order.version += 1
+
+    def import_orders(self, orders: Iterable[Order]) -> int:
+        count = 0
+        with self._conn:
+            for order in orders:
+                self._conn.execute(self._upsert_sql, self._to_row(order))
+                count += 1
+        self._search = None
+        self.rebuild_stats()
+        return count
+
+    def _remove(self, id_: int) -> bool:
+        with self._conn:
+            cursor = self._conn.execute('DELETE FROM orders WHERE id = ?', (self._key(id_),))
+        return cursor.rowcount > 0
+
+    def _remove_many(self, ids: List[int]):
+        with self._conn:
+            self._conn.executemany('DELETE FROM orders WHERE id = ?', [(self._key(id_),) for id_ in ids])
+
+    def get_by_status(
+        self, status: OrderStatus, limit: Optional[int] = None, offset: int = 0,
+        fields: Optional[Projection] = None,
+    ) -> list:
+        rows = self._conn.execute(
+            f'SELECT {self._columns(fields)} FROM orders WHERE status = ? AND archived_at IS NULL '
+            'ORDER BY created_at, id LIMIT ? OFFSET ?',
+            (status.value, -1 if limit is None else limit, offset),
+        )
+        return [self._from_row(row, fields) for row in rows]
+
+    def get_received_before(
+        self, received_before: datetime, limit: Optional[int] = None, fields: Optional[Projection] = None,
+    ) -> list:
+        # No order is received before it was created, so the created_at
+        # bound lets the status index skip the newer orders.
+        cutoff = _format_datetime(received_before)
+        rows = self._conn.execute(
+            f'SELECT {self._columns(fields)} FROM orders WHERE status = ? AND archived_at IS NULL '
+            'AND created_at < ? AND received_by_customer_at < ? ORDER BY created_at, id LIMIT ?',
+            (OrderStatus.DONE.value, cutoff, cutoff, -1 if limit is None else limit),
+        )
+        return [self._from_row(row, fields) for row in rows]
+
+    def get_range(
+        self, start: Optional[datetime] = None, end: Optional[datetime] = None, limit: Optional[int] = None,
+        after: Optional[Cursor] = None, newest_first: bool = False, fields: Optional[Projection] = None,
+    ) -> list:
+        conditions, params = ['archived_at IS NULL'], []
+        if start is not None:
+            conditions.append('created_at >= ?')
+            params.append(_format_datetime(start))
+        if end is not None:
+            conditions.append('created_at < ?')
+            params.append(_format_datetime(end))
+        if after is not None:
+            conditions.append(f'(created_at, id) {"<" if newest_first else ">"} (?, ?)')
+            params.extend((_format_datetime(after[0]), self._key(after[1])))
+        direction = 'DESC' if newest_first else 'ASC'
+        rows = self._conn.execute(
+            f'SELECT {self._columns(fields)} FROM orders WHERE {" AND ".join(conditions)} '
+            f'ORDER BY created_at {direction}, id {direction} LIMIT ?',
+            (*params, -1 if limit is None else limit),
+        )
+        return [self._from_row(row, fields) for row in rows]
+
+    def count_by_status(self, status: OrderStatus) -> int:
+        return self._conn.execute(
+            'SELECT COUNT(*) FROM orders WHERE status = ? AND archived_at IS NULL', (status.value,)
+        ).fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def _iter_all(self, fields: Projection) -> Iterator[tuple]:
+        for row in self._conn.execute(f'SELECT {self._columns(fields)} FROM orders'):
+            yield self._from_row(row, fields)
+
+    def _get(self, id_: int) -> Optional[Order]:
+        row = self._conn.execute(
+            'SELECT * FROM orders WHERE id = ?', (self._key(id_),)
+        ).fetchone()
+        if row:
+            return self._from_row(row)
+        return None
+
+    def _get_archived_in_table(self) -> List[Order]:
+        rows = self._conn.execute('SELECT * FROM orders WHERE archived_at IS NOT NULL')
+        return [self._from_row(row) for row in rows]
+
+    def _project(self, id_: int, fields: Projection) -> Optional[tuple]:
+        row = self._conn.execute(
+            f'SELECT {self._columns(fields)} FROM orders WHERE id = ?', (self._key(id_),)
+        ).fetchone()
+        return self._from_row(row, fields) if row else None
+
+    def _load_stats(self) -> Dict[StatsKey, Totals]:
+        return {
+            (row['kind'], row['key']): Totals(row['orders'], *(Decimal(row[name]) for name in MONEY_FIELDS))
+            for row in self._conn.execute('SELECT * FROM order_stats')
+        }
+
+    def _save_stats(self, changed: Dict[StatsKey, Totals], replace: bool = False):
+        with self._conn:
+            if replace:
+                self._conn.execute('DELETE FROM order_stats')
+            self._conn.executemany(
+                f'INSERT OR REPLACE INTO order_stats VALUES (?, ?, ?, {", ".join("?" * len(MONEY_FIELDS))})',
+                [(*key, totals.orders, *map(str, totals.amounts)) for key, totals in changed.items()],
+            )
+
+    _upsert_sql = (
+        f'INSERT OR REPLACE INTO orders ({", ".join(ORDER_COLUMNS)}) '
+        f'VALUES ({", ".join("?" * len(ORDER_COLUMNS))})'
+    )
+
+    @staticmethod
+    def _key(id_: int) -> str:
+        return f'{id_:032x}'
+
+    @staticmethod
+    def _columns(fields: Optional[Projection]) -> str:
+        if fields is None:
+            return '*'
+        columns = [field.rpartition('.')[2] for field in fields]
+        unknown = set(columns) - set(ORDER_COLUMNS)
+        if unknown:
+            raise ValueError(f'Unknown order fields: {", ".join(sorted(unknown))}')
+        return ', '.join(columns)
+
+    def _to_row(self, order: Order) -> tuple:
+        customer = order.customer_info
+        return (
+            self._key(order.id),
+            _format_datetime(order.created_at),
+            customer.full_name,
+            customer.phone_number,
+            customer.shipping_address,
+            order.shop_url,
+            json.dumps(order.products, ensure_ascii=False),
+            _format_money(order.income),
+            _format_money(order.price),
+            order.delivery_service,
+            _format_money(order.delivery_price),
+            _format_money(order.service_fee),
+            _format_datetime(order.received_at),
+            _format_datetime(order.received_by_customer_at),
+            order.status and order.status.value,
+            json.dumps(order.products_tracking),
+            _format_datetime(order.archived_at),
+            json.dumps(order.unparsed_amounts, ensure_ascii=False) if order.unparsed_amounts else None,
+            order.version,
+        )
+
+    @staticmethod
+    def _from_row(row: sqlite3.Row, fields: Optional[Projection] = None):
+        data = dict(row)
+        if 'id' in data:
+            data['id'] = int(data['id'], 16)
+        data['customer_info'] = {
+            name: data.pop(name) for name in ('full_name', 'phone_number', 'shipping_address') if name in data
+        }
+        for name in ('products', 'products_tracking'):
+            if name in data:
+                data[name] = json.loads(data[name])
+        if 'unparsed_amounts' in data:
+            data['unparsed_amounts'] = json.loads(data['unparsed_amounts'] or '{}')
+        if fields is not None:
+            return project_order(data, fields)
+        return Order(**data)
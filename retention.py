@@ -0,0 +1,34 @@
+import logging
+import time
+from datetime import datetime, timedelta
+
+from telegram.ext import CallbackContext, JobQueue
+
+from handlers import archive_in_batches, orders
+
+logger = logging.getLogger(__name__)
+
+
+async def archive_received_orders(context: CallbackContext):
+    """
+    Archives done orders the customer received more than ``context.job.data``
+    ago, ``batch_size`` at a time, see ``schedule_archiving``.
+    """
+    age, batch_size = context.job.data
+    received_before = datetime.now() - age
+    begin = time.perf_counter()
+    archived = 0
+    # A shard at a time, so at most one more of them is opened for this.
+    for tenant in orders.tenants():
+        chat_orders = orders.of(tenant)
+        archived += await archive_in_batches(
+            chat_orders, lambda: chat_orders.get_received_before(received_before, limit=batch_size, fields=('id',))
+        )
+    logger.info('Archived %s orders received before %s in %.1fs', archived, received_before, time.perf_counter() - begin)
+
+
+def schedule_archiving(job_queue: JobQueue, age: timedelta, interval: float, batch_size: int = 100):
+    """Runs ``archive_received_orders`` every ``interval`` seconds, starting right away."""
+    job_queue.run_repeating(
+        archive_received_orders, interval, first=0, data=(age, batch_size), name='archive_received_orders',
+    )
@@ -0,0 +1,129 @@
+import heapq
+import re
+from bisect import bisect_left
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+WORD = re.compile(r'\w+')
+PHONE_QUERY = re.compile(r'[\d\s+()-]+')
+APOSTROPHES = re.compile("['’ʼ`]")
+IGNORED = frozenset({'http', 'https', 'www'})
+# Word tokens are \w+ and never start with it, so no word prefix matches a phone.
+PHONE_PREFIX = '\x00tel'
+# Shorter phone fragments would match almost every order.
+MIN_PHONE_DIGITS = 4
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased words, with apostrophes dropped so "Мар'яна" and "Марʼяна" match."""
+    return [word for word in WORD.findall(APOSTROPHES.sub('', text).casefold()) if word not in IGNORED]
+
+
+def normalize_phone(text: str) -> str:
+    """Digits without the country code or trunk prefix, "+380 67 123 45 67" is "671234567"."""
+    digits = re.sub(r'\D', '', text)
+    if digits.startswith('380'):
+        return digits[3:]
+    if digits.startswith('0'):
+        return digits[1:]
+    return digits
+
+
+class SearchIndex:
+    """
+    Inverted index from word prefixes and phone number fragments to ids.
+
+    Every token of an order points to its id, and the sorted list of all
+    tokens answers prefix queries with a binary search. New tokens are
+    appended and the list is sorted again before the next query, which
+    keeps building the index linear. Phone numbers are indexed by every
+    suffix of their digits, so any part of a number typed in any format
+    finds it. Matches are returned newest first.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Set[int]] = {}
+        self._tokens: List[str] = []
+        self._sorted = True
+        self._documents: Dict[int, frozenset] = {}
+        self._created: Dict[int, datetime] = {}
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def add(self, id_: int, created_at: Optional[datetime], texts: Iterable[Optional[str]],
+            phones: Iterable[Optional[str]] = ()):
+        tokens = {token for text in texts if text for token in tokenize(text)}
+        for phone in phones:
+            digits = normalize_phone(phone or '')
+            tokens.update(
+                PHONE_PREFIX + digits[start:] for start in range(len(digits) - MIN_PHONE_DIGITS + 1)
+            )
+        tokens = frozenset(tokens)
+
+        old_tokens = self._documents.get(id_, frozenset())
+        for token in tokens - old_tokens:
+            ids = self._postings.get(token)
+            if ids is None:
+                ids = self._postings[token] = set()
+                self._tokens.append(token)
+                self._sorted = False
+            ids.add(id_)
+        self._discard(id_, old_tokens - tokens)
+        self._documents[id_] = tokens
+        self._created[id_] = created_at or datetime.min
+
+    def remove(self, id_: int):
+        tokens = self._documents.pop(id_, None)
+        if tokens is not None:
+            self._discard(id_, tokens)
+            del self._created[id_]
+
+    def search(self, query: str, limit: Optional[int] = None, offset: int = 0) -> Tuple[int, List[int]]:
+        """Returns the number of matches and a page of their ids."""
+        if not self._sorted:
+            self._tokens.sort()
+            self._sorted = True
+
+        ids = self._match_all(tokenize(query))
+        if PHONE_QUERY.fullmatch(query.strip()):
+            digits = normalize_phone(query)
+            if len(digits) >= MIN_PHONE_DIGITS:
+                ids |= self._matching(PHONE_PREFIX + digits)
+
+        if limit is None:
+            newest = sorted(ids, key=self._created.__getitem__, reverse=True)
+        else:
+            newest = heapq.nlargest(offset + limit, ids, key=self._created.__getitem__)
+        return len(ids), newest[offset:]
+
+    def _match_all(self, words: List[str]) -> Set[int]:
+        if not words:
+            return set()
+        # The longest prefix is usually the most selective one.
+        words = sorted(set(words), key=len, reverse=True)
+        ids = self._matching(words[0])
+        for word in words[1:]:
+            if not ids:
+                break
+            ids &= self._matching(word)
+        return ids
+
+    def _matching(self, prefix: str) -> Set[int]:
+        ids = set()
+        position = bisect_left(self._tokens, prefix)
+        while position < len(self._tokens) and self._tokens[position].startswith(prefix):
+            ids |= self._postings[self._tokens[position]]
+            position += 1
+        return ids
+
+    def _discard(self, id_: int, tokens: Iterable[str]):
+        for token in tokens:
+            ids = self._postings[token]
+            ids.discard(id_)
+            if not ids:
+                del self._postings[token]
+                if self._sorted:
+                    del self._tokens[bisect_left(self._tokens, token)]
+                else:
+                    self._tokens.remove(token)
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import os
+import pickle
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set, Tuple, Type
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from model import EditableModel
+
+logger = logging.getLogger(__name__)
+
+ConversationKey = Tuple[int, ...]
+ConversationDict = Dict[ConversationKey, object]
+
+
+@dataclass(slots=True)
+class ChatSession:
+    form: Optional[Type[EditableModel]] = None
+    answers: dict = field(default_factory=dict)
+    last_seen: float = field(default_factory=time.time)
+    query: Optional[str] = None
+    # Ids picked on a page of the listing in selection mode.
+    selected: Set[int] = field(default_factory=set)
+    selected_listing: Optional[int] = None
+
+
+class SessionStore:
+    """
+    Sessions of authenticated chats, least recently used first.
+
+    Sessions idle for longer than ``ttl`` seconds expire, and the least
+    recently used ones are evicted once there are more than ``maxsize``.
+    A chat without a session has to enter the password again.
+    """
+
+    def __init__(self, ttl: float = 7 * 24 * 60 * 60, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.dirty = False
+        self._sessions: 'OrderedDict[int, ChatSession]' = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._sessions
+
+    def get(self, chat_id: int) -> Optional[ChatSession]:
+        session = self._sessions.get(chat_id)
+        if session is None:
+            return None
+        now = time.time()
+        if now - session.last_seen > self.ttl:
+            self.discard(chat_id)
+            return None
+        session.last_seen = now
+        self._sessions.move_to_end(chat_id)
+        self.dirty = True
+        return session
+
+    def create(self, chat_id: int) -> ChatSession:
+        session = self._sessions[chat_id] = ChatSession()
+        self._sessions.move_to_end(chat_id)
+        self.dirty = True
+        self.evict()
+        return session
+
+    def discard(self, chat_id: int):
+        if self._sessions.pop(chat_id, None) is not None:
+            self.dirty = True
+
+    def evict(self) -> int:
+        expired_before = time.time() - self.ttl
+        evicted = 0
+        while self._sessions:
+            chat_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.maxsize and session.last_seen >= expired_before:
+                break
+            del self._sessions[chat_id]
+            evicted += 1
+        if evicted:
+            self.dirty = True
+        return evicted
+
+    def snapshot(self) -> Dict[int, Tuple]:
+        return {
+            chat_id: (
+                session.form, session.answers, session.last_seen, session.query,
+                session.selected, session.selected_listing,
+            )
+            for chat_id, session in self._sessions.items()
+        }
+
+    def restore(self, snapshot: Dict[int, Tuple]):
+        self._sessions = OrderedDict(
+            (chat_id, ChatSession(*values))
+            for chat_id, values in sorted(snapshot.items(), key=lambda item: item[1][2])
+        )
+        self.evict()
+        self.dirty = False
+
+
+class SessionPersistence(BasePersistence):
+    """
+    Saves a ``SessionStore`` and the conversation states to one pickle file.
+
+    No other data is stored. ``update_bot_data`` is the hook the
+    ``Application`` calls every ``update_interval`` seconds, so it is used
+    to evict idle sessions and write a snapshot when anything changed,
+    batching all changes made since the last write into one.
+    """
+
+    def __init__(self, store: SessionStore, filepath: str, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        self.filepath = filepath
+        self._conversations: Dict[str, ConversationDict] = {}
+        self._conversations_changed = False
+        self._write_lock = asyncio.Lock()
+        self._load()
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data: dict) -> None:
+        await self._save()
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        return self._conversations.setdefault(name, {})
+
+    async def update_conversation(self, name: str, key: ConversationKey, new_state: Optional[object]) -> None:
+        conversations = self._conversations.setdefault(name, {})
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        self._conversations_changed = True
+
+    async def flush(self) -> None:
+        await self._save(force=True)
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    def _load(self):
+        if not os.path.exists(self.filepath):
+            return
+        with open(self.filepath, 'rb') as f:
+            data = pickle.load(f)
+        self.store.restore(data['sessions'])
+        self._conversations = data['conversations']
+
+    async def _save(self, force: bool = False):
+        self.store.evict()
+        if not (force or self.store.dirty or self._conversations_changed):
+            return
+
+        # Conversations of evicted chats start over from /start after a restart.
+        conversations = {
+            name: {key: state for key, state in states.items() if key[0] in self.store}
+            for name, states in self._conversations.items()
+        }
+        blob = pickle.dumps({'sessions': self.store.snapshot(), 'conversations': conversations})
+        self.store.dirty = False
+        self._conversations_changed = False
+        async with self._write_lock:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, blob)
+
+    def _write(self, blob: bytes):
+        tmp_path = f'{self.filepath}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, self.filepath)
+        logger.debug('Saved %s sessions to %s', len(self.store), self.filepath)
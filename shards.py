@@ -0,0 +1,171 @@
+import argparse
+import asyncio
+import functools
+import inspect
+import os
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Dict, Hashable, List, Optional
+
+import env
+from repositories import DB_BACKEND, AsyncOrderRepository, OrderRepository, create_order_repository
+
+# One subdirectory of orders per chat when set, all orders in one place otherwise.
+# Every chat then only sees its own orders, where all chats shared them before;
+# migrate.py --split-into-shards copies the shared ones into chosen chats' shards.
+SHARDS_DIR = env.get('DB_SHARDS_DIR', default=None)
+MAX_OPEN_SHARDS = env.get('DB_MAX_OPEN_SHARDS', int, 32)
+
+
+def chat_directory(parser: argparse.ArgumentParser, chat: Optional[int]) -> Optional[str]:
+    """
+    The shard directory of ``chat`` for a command line tool, ``None`` when
+    orders aren't sharded. Exits through ``parser`` unless ``chat`` is given
+    exactly when they are and its shard exists.
+    """
+    if SHARDS_DIR is None:
+        if chat is not None:
+            parser.error('--chat only applies to orders sharded by chat, DB_SHARDS_DIR is not set')
+        return None
+    if chat is None:
+        parser.error('Orders are sharded by chat in DB_SHARDS_DIR, pick one with --chat')
+    directory = os.path.join(SHARDS_DIR, str(chat))
+    if not os.path.isdir(directory):
+        parser.error(f'No orders of chat {chat} in {SHARDS_DIR}')
+    return directory
+
+
+class ShardRouter:
+    """
+    Keeps the orders of every tenant (operator chat) in a repository of
+    its own, under ``directory/<tenant>``, or all of them in the one
+    configured repository when there is no ``directory``. A tenant's
+    handlers only see the orders in its shard, none of the other tenants'.
+
+    Shards are opened on first use, each behind an ``AsyncOrderRepository``
+    with its own executor, so a busy tenant only queues behind itself. At
+    most ``max_open`` shards stay open: the least recently used one with no
+    call in flight is closed when another is opened. Shards are opened with
+    ``open_repository(backend, shard_directory)``.
+    """
+
+    def __init__(
+        self, directory: Optional[str] = SHARDS_DIR, backend: str = DB_BACKEND,
+        max_open: int = MAX_OPEN_SHARDS, max_pending: int = 256,
+        open_repository: Callable[[str, Optional[str]], OrderRepository] = create_order_repository,
+    ):
+        if max_open < 1:
+            raise ValueError(f'At least one shard must stay open, not {max_open}')
+        self._directory = directory
+        self._backend = backend
+        self._max_open = max_open
+        self._max_pending = max_pending
+        self._open_repository = open_repository
+        self._shards: Dict[Hashable, AsyncOrderRepository] = OrderedDict()
+        self._leases: Dict[Hashable, int] = Counter()
+        self._opening: Dict[Hashable, asyncio.Future] = {}
+        self._closing: Dict[Hashable, asyncio.Future] = {}
+        self._on_open: List[Callable[[OrderRepository], None]] = []
+
+    def __len__(self) -> int:
+        return len(self._shards)
+
+    def of(self, tenant: Hashable) -> 'TenantOrders':
+        return TenantOrders(self, tenant)
+
+    def tenants(self) -> List[Hashable]:
+        """Tenants with orders, opened or not."""
+        if self._directory is None:
+            return [None]
+        if not os.path.isdir(self._directory):
+            return []
+        return sorted(int(name) for name in os.listdir(self._directory) if name.lstrip('-').isdigit())
+
+    def on_open(self, callback: Callable[[OrderRepository], None]):
+        """Calls ``callback`` with the repository of every shard, open or opened later."""
+        self._on_open.append(callback)
+        for shard in self._shards.values():
+            callback(shard.repository)
+
+    @asynccontextmanager
+    async def lease(self, tenant: Hashable) -> AsyncIterator[AsyncOrderRepository]:
+        """The tenant's shard, kept open until the block is left."""
+        key = tenant if self._directory is not None else None
+        self._leases[key] += 1
+        try:
+            shard = self._shards.get(key)
+            if shard is None:
+                shard = await self._open(key)
+            self._shards.move_to_end(key)
+            yield shard
+        finally:
+            self._leases[key] -= 1
+            if not self._leases[key]:
+                del self._leases[key]
+            self._evict()
+
+    async def close(self):
+        await asyncio.gather(*self._opening.values(), return_exceptions=True)
+        shards, self._shards = list(self._shards.values()), OrderedDict()
+        await asyncio.gather(*(shard.close() for shard in shards), *self._closing.values())
+
+    async def _open(self, key: Hashable) -> AsyncOrderRepository:
+        opening = self._opening.get(key)
+        if opening is None:
+            opening = self._opening[key] = asyncio.ensure_future(self._open_shard(key))
+        # Callers that give up waiting leave the shard opening for the others.
+        return await asyncio.shield(opening)
+
+    async def _open_shard(self, key: Hashable) -> AsyncOrderRepository:
+        try:
+            if key in self._closing:
+                # Lets the shard's last writes reach its files first.
+                await self._closing[key]
+            directory = None if key is None else os.path.join(self._directory, str(key))
+            repository = await asyncio.get_running_loop().run_in_executor(
+                None, self._open_repository, self._backend, directory
+            )
+            for callback in self._on_open:
+                callback(repository)
+            shard = self._shards[key] = AsyncOrderRepository(repository, self._max_pending)
+            return shard
+        finally:
+            del self._opening[key]
+
+    def _evict(self):
+        idle = [key for key in self._shards if not self._leases.get(key)]
+        for key in idle[:len(self._shards) - self._max_open]:
+            closing = self._closing[key] = asyncio.ensure_future(self._shards.pop(key).close())
+            closing.add_done_callback(functools.partial(self._closed, key))
+
+    def _closed(self, key: Hashable, closing: asyncio.Future):
+        if self._closing.get(key) is closing:
+            del self._closing[key]
+
+
+class TenantOrders:
+    """
+    The ``AsyncOrderRepository`` methods for one tenant's orders, taking a
+    lease on the tenant's shard for the duration of every call.
+    """
+
+    def __init__(self, router: ShardRouter, tenant: Hashable):
+        self._router = router
+        self._tenant = tenant
+
+    def __getattr__(self, name: str):
+        method = getattr(AsyncOrderRepository, name, None)
+        if name.startswith('_') or name == 'close' or not inspect.iscoroutinefunction(method):
+            raise AttributeError(name)
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            async with self._router.lease(self._tenant) as shard:
+                return await method(shard, *args, **kwargs)
+
+        return call
+
+    async def stream(self, func, *args, **kwargs) -> AsyncIterator:
+        async with self._router.lease(self._tenant) as shard:
+            async for item in shard.stream(func, *args, **kwargs):
+                yield item
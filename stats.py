@@ -0,0 +1,133 @@
+import argparse
+import logging
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+from model import MONEY_FIELDS, to_money
+
+logger = logging.getLogger(__name__)
+
+# All an order contributes to the totals.
+STATS_FIELDS = ('created_at', 'status', 'archived_at', *MONEY_FIELDS)
+
+DAY, MONTH, STATUS = 'day', 'month', 'status'
+ARCHIVED = 'archived'
+
+StatsKey = Tuple[str, str]
+
+
+class Totals:
+    __slots__ = ('orders', *MONEY_FIELDS)
+
+    def __init__(self, orders: int = 0, *amounts: Decimal):
+        self.orders = orders
+        for name, amount in zip(MONEY_FIELDS, amounts or [Decimal(0)] * len(MONEY_FIELDS)):
+            setattr(self, name, amount)
+
+    def __add__(self, other: 'Totals') -> 'Totals':
+        return Totals(self.orders + other.orders, *(a + b for a, b in zip(self.amounts, other.amounts)))
+
+    def __repr__(self) -> str:
+        return f'Totals({self.orders}, {", ".join(map(repr, self.amounts))})'
+
+    @property
+    def amounts(self) -> Tuple[Decimal, ...]:
+        return tuple(getattr(self, name) for name in MONEY_FIELDS)
+
+    def copy(self) -> 'Totals':
+        return Totals(self.orders, *self.amounts)
+
+
+def stats_keys(record) -> List[StatsKey]:
+    """The totals an order or a ``STATS_FIELDS`` projection of it counts towards."""
+    if record.archived_at:
+        status = ARCHIVED
+    else:
+        status = record.status.value if record.status else ''
+    keys = [(STATUS, status)]
+    if record.created_at is not None:
+        keys.append((DAY, record.created_at.strftime('%Y-%m-%d')))
+        keys.append((MONTH, record.created_at.strftime('%Y-%m')))
+    return keys
+
+
+def _contribution(record) -> Tuple[List[StatsKey], List[Optional[Decimal]]]:
+    # Amounts assigned after validation may still be text.
+    return stats_keys(record), [to_money(getattr(record, name)) for name in MONEY_FIELDS]
+
+
+class OrderStats:
+    """
+    Order counts and amount sums per creation day, creation month and
+    status, with archived orders counted as ``archived`` instead of their
+    status. Every write applies just the difference it makes, so reading
+    the totals never touches the orders themselves.
+    """
+
+    def __init__(self, totals: Optional[Dict[StatsKey, Totals]] = None):
+        self._totals: Dict[StatsKey, Totals] = totals or {}
+
+    def __len__(self) -> int:
+        return len(self._totals)
+
+    def apply(self, before, after) -> Dict[StatsKey, Totals]:
+        """
+        Replaces what ``before`` counted with ``after``, either of which may
+        be ``None`` for an order that is added or removed. Returns the totals
+        that changed.
+        """
+        removed = _contribution(before) if before is not None else None
+        added = _contribution(after) if after is not None else None
+        if removed == added:
+            return {}
+
+        changed = {}
+        for contribution, sign in ((removed, -1), (added, 1)):
+            if contribution is None:
+                continue
+            keys, amounts = contribution
+            for key in keys:
+                totals = self._totals.get(key)
+                if totals is None:
+                    totals = self._totals[key] = Totals()
+                totals.orders += sign
+                for name, amount in zip(MONEY_FIELDS, amounts):
+                    if amount is not None:
+                        setattr(totals, name, getattr(totals, name) + sign * amount)
+                changed[key] = totals
+        return changed
+
+    def totals(self) -> Dict[StatsKey, Totals]:
+        return dict(self._totals)
+
+    def items(self, kind: str, start: Optional[str] = None, end: Optional[str] = None) -> List[Tuple[str, Totals]]:
+        """Copies of the totals of ``kind`` with keys from ``start`` to ``end`` inclusive, by key."""
+        return sorted(
+            (key, totals.copy()) for (totals_kind, key), totals in self._totals.items()
+            if totals_kind == kind and (start is None or key >= start) and (end is None or key <= end)
+        )
+
+
+def main():
+    # Imported here, the repositories themselves import this module.
+    from repositories import DB_BACKEND, create_order_repository
+    from shards import chat_directory
+
+    parser = argparse.ArgumentParser(
+        description='Recount order totals from all stored orders. Run it while the bot is stopped.'
+    )
+    parser.add_argument('--backend', choices=['tinydb', 'sqlite'], default=DB_BACKEND)
+    parser.add_argument('--chat', type=int, help='Chat whose totals to recount when orders are sharded by chat')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    repository = create_order_repository(args.backend, chat_directory(parser, args.chat))
+    try:
+        count = repository.rebuild_stats()
+    finally:
+        repository.close()
+    logger.info('Counted %s orders', count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,558 @@
+import gc
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal
+from itertools import chain
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, Type
+
+import msgpack
+from tinydb import Storage
+from tinydb.table import Table
+from tinydb_serialization import Serializer
+
+logger = logging.getLogger(__name__)
+
+Record = Tuple[str, Optional[str], Optional[dict]]
+
+
+@contextmanager
+def paused_gc() -> Iterator[None]:
+    # Decoding allocates millions of containers and none of them is garbage,
+    # so the collector would only run over them again and again.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class DecimalSerializer(Serializer):
+    OBJ_CLASS = Decimal
+
+    def encode(self, obj):
+        return str(obj)
+
+    def decode(self, s):
+        return Decimal(s)
+
+
+class Codec:
+    """
+    Turns the database and write-ahead log records into bytes and back.
+    Data another codec wrote is refused, see ``detect_codec``.
+    """
+
+    NAME = ''
+
+    def register_serializer(self, serializer: Serializer, name: str):
+        pass
+
+    def recognizes(self, data: bytes) -> bool:
+        raise NotImplementedError
+
+    def dumps(self, value) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes):
+        raise NotImplementedError
+
+    def dump_records(self, records: List[Record]) -> bytes:
+        raise NotImplementedError
+
+    def load_records(self, data: bytes) -> Tuple[List[Record], int]:
+        """Returns the records and the length of the intact part of ``data``."""
+        raise NotImplementedError
+
+    def _check(self, data: bytes):
+        if data and not self.recognizes(data):
+            written_with = detect_codec(data)
+            raise ValueError(
+                f'The file was written with DB_CODEC={written_with}, not {self.NAME}, '
+                f'open it with that codec or convert it with convert.py'
+                if written_with else f'The file is not in the {self.NAME} format'
+            )
+
+
+class JSONCodec(Codec):
+    """
+    The format of ``SerializationMiddleware(JSONStorage)``.
+
+    Values handled by a registered serializer are stored as
+    ``{Name}:<encoded>`` strings. The log holds one record per line.
+    """
+
+    NAME = 'json'
+
+    def __init__(self, encoding: str = 'utf-8'):
+        self._encoding = encoding
+        self._serializers: Dict[str, Serializer] = {}
+        self._classes: Dict[type, Tuple[str, Serializer]] = {}
+
+    def register_serializer(self, serializer: Serializer, name: str):
+        self._serializers[name] = serializer
+        self._classes[serializer.OBJ_CLASS] = (name, serializer)
+
+    def recognizes(self, data: bytes) -> bool:
+        # An object for the database, an array per log record.
+        return data.lstrip()[:1] in (b'{', b'[')
+
+    def dumps(self, value) -> bytes:
+        return json.dumps(value, ensure_ascii=False, default=self._default).encode(self._encoding)
+
+    def loads(self, data: bytes):
+        self._check(data)
+        return self._decode(json.loads(data.decode(self._encoding)))
+
+    def dump_records(self, records: List[Record]) -> bytes:
+        return b''.join(self.dumps(record) + b'\n' for record in records)
+
+    def load_records(self, data: bytes) -> Tuple[List[Record], int]:
+        self._check(data)
+        records = []
+        lines = data.splitlines(keepends=True)
+        length = 0
+        for n, line in enumerate(lines):
+            try:
+                records.append(tuple(self.loads(line)))
+            except ValueError:
+                if n == len(lines) - 1:
+                    break
+                raise
+            length += len(line)
+        return records, length
+
+    def _default(self, obj):
+        name, serializer = self._classes.get(type(obj), (None, None))
+        if serializer is None:
+            for name, serializer in self._serializers.items():
+                if isinstance(obj, serializer.OBJ_CLASS):
+                    break
+            else:
+                raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+        return f'{{{name}}}:{serializer.encode(obj)}'
+
+    def _decode(self, element):
+        items = element.items() if isinstance(element, dict) else enumerate(element)
+        for key, value in items:
+            if isinstance(value, str):
+                if value[:1] == '{':
+                    end = value.find('}:')
+                    serializer = self._serializers.get(value[1:end]) if end > 0 else None
+                    if serializer is not None:
+                        element[key] = serializer.decode(value[end + 2:])
+            elif isinstance(value, (dict, list)):
+                self._decode(value)
+        return element
+
+
+class MsgpackCodec(Codec):
+    """
+    Binary MessagePack format, decoded in C. Datetimes, decimals and
+    integers beyond 64 bits, such as order ids, are extension types
+    holding their text or bytes. The log is a stream of records.
+    """
+
+    NAME = 'msgpack'
+    BIG_INT, DECIMAL, DATETIME = 1, 2, 3
+    # Maps for the database, arrays for log records: fixmap, fixarray,
+    # array 16 and 32, map 16 and 32.
+    _HEADERS = frozenset(chain(range(0x80, 0xa0), range(0xdc, 0xe0)))
+
+    def recognizes(self, data: bytes) -> bool:
+        return bool(data) and data[0] in self._HEADERS
+
+    def dumps(self, value) -> bytes:
+        return msgpack.packb(value, default=self._default)
+
+    def loads(self, data: bytes):
+        self._check(data)
+        return msgpack.unpackb(data, ext_hook=self._ext_hook, strict_map_key=False)
+
+    def dump_records(self, records: List[Record]) -> bytes:
+        packer = msgpack.Packer(default=self._default)
+        return b''.join(packer.pack(record) for record in records)
+
+    def load_records(self, data: bytes) -> Tuple[List[Record], int]:
+        self._check(data)
+        unpacker = msgpack.Unpacker(ext_hook=self._ext_hook, strict_map_key=False, max_buffer_size=0)
+        unpacker.feed(data)
+        records = []
+        length = 0
+        try:
+            # Stops at a record cut short.
+            for record in unpacker:
+                records.append(tuple(record))
+                length = unpacker.tell()
+        except (ValueError, msgpack.UnpackException):
+            pass
+        return records, length
+
+    def _default(self, obj):
+        # Called for integers out of the 64-bit range too.
+        if isinstance(obj, int):
+            return msgpack.ExtType(self.BIG_INT, obj.to_bytes((obj.bit_length() + 8) // 8, 'big', signed=True))
+        if isinstance(obj, Decimal):
+            return msgpack.ExtType(self.DECIMAL, str(obj).encode('ascii'))
+        if isinstance(obj, datetime):
+            return msgpack.ExtType(self.DATETIME, obj.isoformat().encode('ascii'))
+        raise TypeError(f'Object of type {type(obj).__name__} is not MessagePack serializable')
+
+    def _ext_hook(self, code: int, data: bytes):
+        if code == self.BIG_INT:
+            return int.from_bytes(data, 'big', signed=True)
+        if code == self.DECIMAL:
+            return Decimal(data.decode('ascii'))
+        if code == self.DATETIME:
+            return datetime.fromisoformat(data.decode('ascii'))
+        return msgpack.ExtType(code, data)
+
+
+CODECS: Dict[str, Type[Codec]] = {
+    'json': JSONCodec,
+    'msgpack': MsgpackCodec,
+}
+
+
+def detect_codec(data: bytes) -> Optional[str]:
+    """The name of the codec ``data`` was written with, if any."""
+    for name, codec_class in CODECS.items():
+        if codec_class().recognizes(data):
+            return name
+    return None
+
+
+class CodecStorage(Storage):
+    """
+    The whole database in one file written through a ``Codec``.
+
+    With ``JSONCodec`` a drop-in replacement for
+    ``SerializationMiddleware(JSONStorage)``. Writes go to a temporary file
+    first. The decoded file is kept until the next write, or until its
+    modification time or size shows it was written by someone else, so
+    reads don't decode the whole file again.
+    """
+
+    def __init__(self, path: str, codec: Codec):
+        self._path = path
+        self._codec = codec
+        self._data: Optional[Dict[str, Dict[str, Any]]] = None
+        self._stat: Optional[Tuple[int, int]] = None
+
+    def read(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        stat = self._file_stat()
+        if stat is None or not stat[1]:
+            return None
+        if self._data is None or stat != self._stat:
+            with open(self._path, 'rb') as f, paused_gc():
+                self._data = self._codec.loads(f.read())
+            self._stat = stat
+        return self._data
+
+    def write(self, data: Dict[str, Dict[str, Any]]) -> None:
+        # TinyDB changes documents of the data read in place, so whatever
+        # is kept no longer matches the file if writing fails.
+        self._data = None
+        tmp_path = f'{self._path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self._codec.dumps(data))
+        os.replace(tmp_path, self._path)
+        self._data, self._stat = data, self._file_stat()
+
+    def _file_stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+
+class WriteAheadLogStorage(Storage):
+    """
+    Keeps the whole database in memory and persists only what changed.
+
+    ``write`` diffs the new state against the last committed one and queues
+    the changed documents. TinyDB replaces the dict of every table it
+    changes, so tables that are still the objects seen by the previous
+    write are skipped. Tables of ``LoggedTable`` are changed in place and
+    report the documents they touched to ``write_docs``, which compares
+    just those. A background thread group-commits the queue to
+    ``<path>.wal`` every ``commit_interval`` seconds and compacts the log
+    into ``path`` once it grows past ``compact_threshold`` bytes. Both files
+    are written through ``codec``.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        codec: Optional[Codec] = None,
+        commit_interval: float = 0.5,
+        compact_threshold: int = 4 * 1024 * 1024,
+        max_batch: int = 1000,
+        fsync: bool = True,
+    ):
+        self._path = path
+        self._wal_path = f'{path}.wal'
+        self._codec = codec or JSONCodec()
+        self._commit_interval = commit_interval
+        self._compact_threshold = compact_threshold
+        self._max_batch = max_batch
+        self._fsync = fsync
+
+        self._data: Optional[Dict[str, Dict[str, dict]]] = None
+        self._committed: Dict[str, Dict[str, dict]] = {}
+        self._written: Dict[str, dict] = {}
+        self._pending: List[Record] = []
+
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def register_serializer(self, serializer: Serializer, name: str):
+        self._codec.register_serializer(serializer, name)
+
+    def read(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        with self._lock:
+            if self._data is None:
+                self._load()
+            return self._data
+
+    def write(self, data: Dict[str, Dict[str, Any]]) -> None:
+        with self._lock:
+            for table_name, table in data.items():
+                if self._written.get(table_name) is table:
+                    continue
+                committed = self._committed.setdefault(table_name, {})
+                for doc_id, doc in table.items():
+                    if committed.get(doc_id) != doc:
+                        committed[doc_id] = dict(doc)
+                        self._pending.append((table_name, doc_id, committed[doc_id]))
+                for doc_id in committed.keys() - table.keys():
+                    del committed[doc_id]
+                    self._pending.append((table_name, doc_id, None))
+            for table_name in self._committed.keys() - data.keys():
+                del self._committed[table_name]
+                self._pending.append((table_name, None, None))
+            self._data = data
+            self._written = dict(data)
+            pending = len(self._pending)
+
+        if pending:
+            self._ensure_committer()
+            if pending >= self._max_batch:
+                self._wakeup.set()
+
+    def write_docs(self, data: Dict[str, Dict[str, Any]], table_name: str, doc_ids: Iterable[str]) -> None:
+        """Like ``write``, for a change of ``doc_ids`` of one table only, made in place."""
+        with self._lock:
+            table = data.get(table_name, {})
+            committed = self._committed.setdefault(table_name, {})
+            for doc_id in doc_ids:
+                doc = table.get(doc_id)
+                if doc is None:
+                    if committed.pop(doc_id, None) is not None:
+                        self._pending.append((table_name, doc_id, None))
+                elif committed.get(doc_id) != doc:
+                    committed[doc_id] = dict(doc)
+                    self._pending.append((table_name, doc_id, committed[doc_id]))
+            self._data = data
+            self._written[table_name] = table
+            pending = len(self._pending)
+
+        if pending:
+            self._ensure_committer()
+            if pending >= self._max_batch:
+                self._wakeup.set()
+
+    def flush(self, compact: bool = False) -> None:
+        with self._io_lock:
+            compact = compact or self._wal_size() >= self._compact_threshold
+            with self._lock:
+                batch, self._pending = self._pending, []
+                snapshot = {name: dict(table) for name, table in self._committed.items()} if compact else None
+
+            if snapshot is not None:
+                self._write_snapshot(snapshot)
+            elif batch:
+                self._append(batch)
+
+    def close(self) -> None:
+        self._closed.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._data is not None:
+            self.flush(compact=True)
+
+    def _ensure_committer(self):
+        if self._thread is None and not self._closed.is_set():
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name='wal-committer', daemon=True
+                    )
+                    self._thread.start()
+
+    def _run(self):
+        while not self._closed.is_set():
+            self._wakeup.wait(self._commit_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to commit write-ahead log')
+
+    def _load(self):
+        data, intact = read_database(self._path, self._codec)
+        if intact < self._wal_size():
+            # A torn write of the last batch, everything before it is intact.
+            logger.warning('Dropping incomplete record at the end of %s', self._wal_path)
+            with open(self._wal_path, 'r+b') as f:
+                f.truncate(intact)
+                self._sync(f)
+        self._committed = {name: {doc_id: dict(doc) for doc_id, doc in table.items()} for name, table in data.items()}
+        self._data = data
+        self._written = dict(data)
+
+    def _append(self, batch: List[Record]):
+        with open(self._wal_path, 'ab') as f:
+            f.write(self._codec.dump_records(batch))
+            self._sync(f)
+
+    def _write_snapshot(self, snapshot: Dict[str, Dict[str, dict]]):
+        tmp_path = f'{self._path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self._codec.dumps(snapshot))
+            self._sync(f)
+        os.replace(tmp_path, self._path)
+        with open(self._wal_path, 'wb') as f:
+            self._sync(f)
+
+    def _sync(self, f):
+        f.flush()
+        if self._fsync:
+            os.fsync(f.fileno())
+
+    def _wal_size(self) -> int:
+        try:
+            return os.path.getsize(self._wal_path)
+        except OSError:
+            return 0
+
+
+class _TouchedDocs(MutableMapping):
+    """
+    The documents of a stored table, keyed by their string ids, as the
+    table of int ids TinyDB updates, recording the ids it reads or writes.
+    """
+
+    def __init__(self, docs: Dict[str, dict], document_id_class: Callable[[str], int]):
+        self._docs = docs
+        self._document_id_class = document_id_class
+        self.touched: Set[str] = set()
+
+    def __getitem__(self, doc_id):
+        key = str(doc_id)
+        doc = self._docs[key]
+        self.touched.add(key)
+        return doc
+
+    def __setitem__(self, doc_id, doc):
+        key = str(doc_id)
+        self._docs[key] = doc
+        self.touched.add(key)
+
+    def __delitem__(self, doc_id):
+        key = str(doc_id)
+        del self._docs[key]
+        self.touched.add(key)
+
+    def __contains__(self, doc_id) -> bool:
+        return str(doc_id) in self._docs
+
+    def __iter__(self) -> Iterator[int]:
+        return map(self._document_id_class, self._docs)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def clear(self):
+        self.touched.update(self._docs)
+        self._docs.clear()
+
+
+class LoggedTable(Table):
+    """
+    A table of a ``WriteAheadLogStorage`` updated in place, so a write
+    costs as much as the documents it touches rather than the whole table.
+    """
+
+    def _update_table(self, updater: Callable[[Dict[int, Mapping]], None]):
+        tables = self._storage.read()
+        if tables is None:
+            tables = {}
+        table = _TouchedDocs(tables.setdefault(self.name, {}), self.document_id_class)
+        updater(table)
+        self._storage.write_docs(tables, self.name, table.touched)
+        self.clear_cache()
+
+
+def read_database(path: str, codec: Codec) -> Tuple[Dict[str, Dict[str, dict]], int]:
+    """
+    The tables of ``path`` with the records of ``<path>.wal`` applied, and
+    the length of the intact part of the log. Neither file is changed, and
+    both must have been written with ``codec``.
+    """
+    data = {}
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb') as f:
+            raw = f.read()
+        with paused_gc():
+            data = codec.loads(raw)
+
+    length = 0
+    if os.path.exists(f'{path}.wal'):
+        with open(f'{path}.wal', 'rb') as f:
+            raw = f.read()
+        with paused_gc():
+            records, length = codec.load_records(raw)
+        for table_name, doc_id, doc in records:
+            if doc_id is None:
+                data.pop(table_name, None)
+            elif doc is None:
+                data.get(table_name, {}).pop(doc_id, None)
+            else:
+                data.setdefault(table_name, {})[doc_id] = doc
+    return data, length
+
+
+def detect_file_codec(path: str) -> Optional[str]:
+    """The codec the database at ``path``, or else its log, was written with."""
+    for file_path in (path, f'{path}.wal'):
+        if os.path.exists(file_path) and os.path.getsize(file_path):
+            with open(file_path, 'rb') as f:
+                return detect_codec(f.read(16))
+    return None
+
+
+def convert_database(path: str, codecs: Dict[str, Codec], target: str) -> Optional[str]:
+    """
+    Rewrites ``path`` and its log as one file in the ``target`` format of
+    ``codecs``, returns the format it was in. Run it while nothing has the
+    database open.
+    """
+    source = detect_file_codec(path)
+    if source is None or source == target:
+        return source
+    data, _ = read_database(path, codecs[source])
+    storage = WriteAheadLogStorage(path, codecs[target], fsync=True)
+    storage._write_snapshot(data)
+    return source